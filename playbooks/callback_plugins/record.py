@@ -0,0 +1,65 @@
+import os
+import time
+import json
+import threading
+
+
+class CallbackModule(object):
+    """
+    This Ansible callback plugin records the callbacks
+    of a playbook run, to replay them through the sqs
+    callback plugin with util/vpc-tools/pipeline_benchmark.py.
+
+    The following vars must be set in the environment:
+        ANSIBLE_RECORD_CALLBACKS - file to append the
+                                   callbacks to
+
+    Every callback is written as a line of JSON with its
+    seconds since the start of the run ("t"), name and
+    arguments. The stats of playbook_on_stats are written
+    as a dict of their counters.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.filename = os.environ.get('ANSIBLE_RECORD_CALLBACKS')
+
+    def _record(self, callback, *args):
+        if not self.filename:
+            return
+        line = json.dumps({'t': time.time() - self.start_time,
+                           'callback': callback, 'args': args},
+                          default=repr)
+        with self.lock:
+            with open(self.filename, 'a') as f:
+                f.write(line + '\n')
+
+    def runner_on_failed(self, host, res, ignore_errors=False):
+        self._record('runner_on_failed', host, res, ignore_errors)
+
+    def runner_on_ok(self, host, res):
+        self._record('runner_on_ok', host, res)
+
+    def runner_on_skipped(self, host, item=None):
+        self._record('runner_on_skipped', host, item)
+
+    def runner_on_unreachable(self, host, res):
+        self._record('runner_on_unreachable', host, res)
+
+    def playbook_on_task_start(self, name, is_conditional):
+        self._record('playbook_on_task_start', name, is_conditional)
+
+    def playbook_on_handler_task_start(self, name):
+        self._record('playbook_on_handler_task_start', name)
+
+    def playbook_on_setup(self):
+        self._record('playbook_on_setup')
+
+    def playbook_on_play_start(self, pattern):
+        self._record('playbook_on_play_start', pattern)
+
+    def playbook_on_stats(self, stats):
+        counters = dict(
+            (s, getattr(stats, s))
+            for s in ['changed', 'failures', 'ok', 'processed', 'skipped'])
+        self._record('playbook_on_stats', counters)
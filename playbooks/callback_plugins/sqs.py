@@ -20,6 +20,12 @@ import os
 import sys
 import time
 import json
+import zlib
+import base64
+import atexit
+import itertools
+import threading
+from collections import deque
 try:
     import boto.sqs
     from boto.exception import NoAuthHandlerFound
@@ -28,6 +34,235 @@ except ImportError:
     raise
 
 
+# SQS limits for a single SendMessageBatch request
+SQS_BATCH_MAX_MESSAGES = 10
+SQS_BATCH_MAX_BYTES = 256 * 1024
+
+# SQS limit for a single message, less room for the
+# envelope of a chunk
+SQS_MAX_MESSAGE_BYTES = 256 * 1024
+SQS_CHUNK_BYTES = SQS_MAX_MESSAGE_BYTES - 1024
+
+# Attempts at sending a batch before its messages are dropped
+SQS_SEND_ATTEMPTS = 5
+
+# Seconds to wait for the last messages to be sent when the
+# playbook ends
+SQS_DRAIN_TIMEOUT = 60
+
+# Statuses of a host in a task summary, a host whose items
+# ended differently gets the last of them
+HOST_STATUSES = ['skipped', 'ok', 'unreachable', 'failed']
+
+
+class PayloadEncoder(object):
+    """
+    Turns event payloads into SQS message bodies.
+
+    The results of OK and FAILURE events can be projected
+    onto the given fields. A payload is sent as plain JSON
+    unless compression is on, in which case it is sent as
+    {"ENCODING": "zlib+base64", "DATA": ...} along with its
+    TS and PREFIX.
+
+    Payloads that do not fit in an SQS message are split
+    into parts that carry a CHUNK of {"ID", "PART", "PARTS"}
+    and a slice of the base64 DATA. The decoder in
+    util/vpc-tools/abbey.py puts them back together.
+    """
+    def __init__(self, fields=None, compress=False,
+                 chunk_bytes=SQS_CHUNK_BYTES):
+        self.fields = fields
+        self.compress = compress
+        self.chunk_bytes = chunk_bytes
+        self.chunk_ids = itertools.count()
+
+    def project(self, result):
+        # always a copy, the result is still used by ansible
+        if not isinstance(result, dict):
+            return result
+        if not self.fields:
+            return dict(result)
+        return dict((key, value) for key, value in result.iteritems()
+                    if key in self.fields)
+
+    def encode(self, payload):
+        """
+        Returns the list of message bodies of a payload
+        """
+        body = json.dumps(payload)
+        if not self.compress and len(body) <= self.chunk_bytes:
+            return [body]
+
+        if self.compress:
+            encoding = 'zlib+base64'
+            data = base64.b64encode(zlib.compress(body))
+        else:
+            encoding = 'base64'
+            data = base64.b64encode(body)
+
+        envelope = {
+            'ENCODING': encoding,
+            'TS': payload['TS'],
+            'PREFIX': payload['PREFIX'],
+        }
+        if len(data) <= self.chunk_bytes:
+            envelope['DATA'] = data
+            return [json.dumps(envelope)]
+
+        chunk_id = '{}-{}'.format(os.getpid(), next(self.chunk_ids))
+        parts = range(0, len(data), self.chunk_bytes)
+        bodies = []
+        for part, offset in enumerate(parts):
+            envelope['CHUNK'] = {
+                'ID': chunk_id,
+                'PART': part,
+                'PARTS': len(parts),
+            }
+            envelope['DATA'] = data[offset:offset + self.chunk_bytes]
+            bodies.append(json.dumps(envelope))
+        return bodies
+
+
+class SQSPublisher(threading.Thread):
+    """
+    Sends messages to an SQS queue from a background thread
+    so that the playbook does not wait on SQS.
+
+    Messages are sent in batches of up to 10 once 10 messages
+    are pending, the batch size limit is reached, or the oldest
+    pending message has waited flush_interval seconds.
+
+    Ansible runs the callbacks of tasks on several hosts in
+    forked workers, which have no sending thread. Messages
+    published there are sent right away on a connection of
+    their own.
+    """
+    def __init__(self, sqs, queue, flush_interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = os.getpid()
+        self.sqs = sqs
+        self.sqs_pid = self.pid
+        self.queue = queue
+        self.flush_interval = flush_interval
+
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.oldest_ts = None
+        self.sending = 0
+        self.flushing = 0
+        self.closed = False
+
+    def publish(self, body):
+        if os.getpid() != self.pid:
+            self._send_forked(body)
+            return
+        with self.condition:
+            if not self.pending:
+                self.oldest_ts = time.time()
+            self.pending.append(body)
+            self.pending_bytes += len(body)
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every published message has been
+        sent, or until timeout seconds have passed
+        """
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            deadline = time.time() + timeout if timeout else None
+            while (self.pending or self.sending) and self.is_alive():
+                if deadline is None:
+                    self.condition.wait(1)
+                elif time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                else:
+                    break
+            self.flushing -= 1
+
+    def close(self, timeout=SQS_DRAIN_TIMEOUT):
+        self.flush(timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self._batch_ready():
+                    if self.closed:
+                        return
+                    self.condition.wait(self._wait_time())
+                batch = self._take_batch()
+                self.sending = len(batch)
+
+            self._send_batch(batch)
+
+            with self.condition:
+                self.sending = 0
+                self.condition.notify_all()
+
+    def _batch_ready(self):
+        if not self.pending:
+            return False
+        return (self.flushing or self.closed or
+                len(self.pending) >= SQS_BATCH_MAX_MESSAGES or
+                self.pending_bytes >= SQS_BATCH_MAX_BYTES or
+                time.time() - self.oldest_ts >= self.flush_interval)
+
+    def _wait_time(self):
+        if not self.pending:
+            # nothing to do until a message is published
+            return None
+        return max(0, self.oldest_ts + self.flush_interval - time.time())
+
+    def _take_batch(self):
+        batch = []
+        size = 0
+        while self.pending and len(batch) < SQS_BATCH_MAX_MESSAGES:
+            body = self.pending[0]
+            if batch and size + len(body) > SQS_BATCH_MAX_BYTES:
+                break
+            batch.append(self.pending.popleft())
+            size += len(body)
+        # oldest_ts is left as is, anything still pending is
+        # sent with the next batch right away
+        self.pending_bytes -= size
+        return batch
+
+    def _send_forked(self, body):
+        if self.sqs_pid != os.getpid():
+            # the connection of the parent can't be shared
+            self.sqs = boto.sqs.connect_to_region(self.sqs.region.name)
+            self.sqs_pid = os.getpid()
+        self._send_batch([body])
+
+    def _send_batch(self, batch):
+        entries = [(str(i), body, 0) for i, body in enumerate(batch)]
+        error = None
+        for attempt in range(SQS_SEND_ATTEMPTS):
+            if attempt:
+                time.sleep(2 ** attempt * 0.1)
+            try:
+                result = self.sqs.send_message_batch(self.queue, entries)
+            except Exception as e:
+                # keep the thread alive, the messages are retried
+                error = e
+                continue
+            failed = set(entry['id'] for entry in result.errors)
+            entries = [entry for entry in entries if entry[0] in failed]
+            if not entries:
+                return
+            error = ', '.join(entry.get('error_message', entry['id'])
+                              for entry in result.errors)
+        print 'Dropped {} SQS messages after {} attempts: {}'.format(
+            len(entries), SQS_SEND_ATTEMPTS, error)
+
+
 class CallbackModule(object):
     """
     This Ansible callback plugin sends task events
@@ -38,16 +273,52 @@ class CallbackModule(object):
         SQS_REGION - AWS region to connect to
         SQS_MSG_PREFIX - Additional data that will be put
                          on the queue (optional)
+        SQS_FLUSH_INTERVAL - Seconds an event can wait to be
+                             batched with the next ones before
+                             it is sent (optional, default 1)
+        SQS_MSG_FIELDS - Comma separated keys of the OK and
+                         FAILURE results to send (optional,
+                         all keys by default)
+        SQS_MSG_COMPRESS - Compresses the events if set
+                           (optional)
+
+    Events are sent in batches from a background thread,
+    the remaining events are sent before playbook_on_stats
+    returns.
 
     The following events are put on the queue
         - FAILURE events
         - OK events
-        - TASK events
+        - TASK events, with HANDLER set for handlers
         - START events
+        - SUMMARY events
+        - STATS events
+
+    Every event carries the RUN it belongs to, the start time
+    of this ansible-playbook run, and its SEQ number within
+    the run so that they can be put back in order. Events of
+    forked workers have no SEQ, their numbers would clash.
+
+    OK and FAILURE events carry the HOST and its timings:
+        delta - seconds since the previous result of the
+                host for the task, i.e. the duration of
+                the item for loops, or since the task started
+        task_delta - seconds since the task started
+        item - number of the item for loops, from 1
+
+    The SUMMARY event sent before STATS has the wall time of
+    every task and handler and the time and number of items
+    of every host that ran it.
     """
     def __init__(self):
 
         self.start_time = time.time()
+        self.pid = os.getpid()
+        self.seq = itertools.count()
+        # timings of the tasks run so far and of the one
+        # running, see _start_task
+        self.tasks = []
+        self.task = None
 
         if 'ANSIBLE_ENABLE_SQS' in os.environ:
             self.enable_sqs = True
@@ -73,54 +344,160 @@ class CallbackModule(object):
             else:
                 self.prefix = ''
 
-            self.last_seen_ts = {}
+            fields = None
+            if os.environ.get('SQS_MSG_FIELDS'):
+                fields = set(os.environ['SQS_MSG_FIELDS'].split(','))
+            self.encoder = PayloadEncoder(
+                fields=fields, compress='SQS_MSG_COMPRESS' in os.environ)
+
+            flush_interval = float(os.environ.get('SQS_FLUSH_INTERVAL', 1))
+            self.publisher = SQSPublisher(self.sqs, self.queue,
+                                          flush_interval)
+            self.publisher.start()
+            # the playbook can exit without reaching playbook_on_stats
+            atexit.register(self.publisher.close)
         else:
             self.enable_sqs = False
 
     def runner_on_failed(self, host, res, ignore_errors=False):
         if self.enable_sqs:
+            timing = self._host_result(host, res, 'failed')
             if not ignore_errors:
-                self._send_queue_message(res, 'FAILURE')
+                self._send_queue_message(res, 'FAILURE', host, timing)
 
     def runner_on_ok(self, host, res):
         if self.enable_sqs:
+            timing = self._host_result(host, res, 'ok')
             # don't send the setup results
             if res['invocation']['module_name'] != "setup":
-                self._send_queue_message(res, 'OK')
+                self._send_queue_message(res, 'OK', host, timing)
+
+    def runner_on_skipped(self, host, item=None):
+        if self.enable_sqs:
+            res = {} if item is None else {'item': item}
+            self._host_result(host, res, 'skipped')
+
+    def runner_on_unreachable(self, host, res):
+        if self.enable_sqs:
+            self._host_result(host, {}, 'unreachable')
 
     def playbook_on_task_start(self, name, is_conditional):
         if self.enable_sqs:
+            self._start_task(name, False)
+            self._send_queue_message(name, 'TASK')
+
+    def playbook_on_handler_task_start(self, name):
+        if self.enable_sqs:
+            self._start_task(name, True)
             self._send_queue_message(name, 'TASK')
 
+    def playbook_on_setup(self):
+        if self.enable_sqs:
+            # keeps fact gathering out of the time of the
+            # previous task, its results are not sent
+            self._start_task('GATHERING FACTS', False)
+
     def playbook_on_play_start(self, pattern):
         if self.enable_sqs:
+            self._end_task()
             self._send_queue_message(pattern, 'START')
 
     def playbook_on_stats(self, stats):
         if self.enable_sqs:
+            self._end_task()
+            self._send_queue_message(self._summary(), 'SUMMARY')
             d = {}
             delta = time.time() - self.start_time
             d['delta'] = delta
             for s in ['changed', 'failures', 'ok', 'processed', 'skipped']:
                 d[s] = getattr(stats, s)
             self._send_queue_message(d, 'STATS')
+            # everything has to be on the queue before ansible exits
+            self.publisher.flush(SQS_DRAIN_TIMEOUT)
+
+    def _start_task(self, name, handler):
+        self._end_task()
+        now = time.time()
+        self.task = {
+            'name': name,
+            'handler': handler,
+            'start': now,
+            # host to its first and last result, items and status
+            'hosts': {},
+        }
+
+    def _end_task(self):
+        # a task ends when the next one starts, results of all
+        # hosts are in by then
+        if self.task:
+            self.task['wall'] = time.time() - self.task['start']
+            self.tasks.append(self.task)
+            self.task = None
+
+    def _host_result(self, host, res, status):
+        """
+        Records a result of host for the running task,
+        returns the timing fields of its event
+        """
+        now = time.time()
+        if not self.task:
+            return {}
+        timing = self.task['hosts'].setdefault(host, {
+            'last': self.task['start'],
+            'items': 0,
+            'status': status,
+        })
+        delta = now - timing['last']
+        timing['last'] = now
+        timing['status'] = max(timing['status'], status,
+                               key=HOST_STATUSES.index)
+
+        fields = {
+            'delta': delta,
+            'task_delta': now - self.task['start'],
+        }
+        if 'item' in res:
+            timing['items'] += 1
+            fields['item'] = timing['items']
+        return fields
+
+    def _summary(self):
+        """
+        Returns the wall time of every task and the time
+        of every host in it. Results handled by forked
+        workers are only in their own events.
+        """
+        tasks = []
+        for task in self.tasks:
+            hosts = {}
+            for host, timing in task['hosts'].iteritems():
+                hosts[host] = {
+                    'time': timing['last'] - task['start'],
+                    'items': timing['items'],
+                    'status': timing['status'],
+                }
+            summary = {'name': task['name'], 'wall': task['wall'],
+                       'hosts': hosts}
+            if task['handler']:
+                summary['handler'] = True
+            tasks.append(summary)
+        return {'delta': time.time() - self.start_time, 'tasks': tasks}
 
-    def _send_queue_message(self, msg, msg_type):
+    def _send_queue_message(self, msg, msg_type, host=None, timing=None):
         if self.enable_sqs:
             from_start = time.time() - self.start_time
             payload = {msg_type: msg}
             payload['TS'] = from_start
             payload['PREFIX'] = self.prefix
-            # update the last seen timestamp for
-            # the message type
-            self.last_seen_ts[msg_type] = time.time()
+            payload['RUN'] = self.start_time
+            if os.getpid() == self.pid:
+                payload['SEQ'] = next(self.seq)
+            if msg_type == 'TASK' and self.task['handler']:
+                payload['HANDLER'] = True
             if msg_type in ['OK', 'FAILURE']:
-                # report the delta between the OK/FAILURE and
-                # last TASK
-                if 'TASK' in self.last_seen_ts:
-                    from_task = \
-                        self.last_seen_ts[msg_type] - self.last_seen_ts['TASK']
-                    payload['delta'] = from_task
+                payload['HOST'] = host
+                payload.update(timing)
+                payload[msg_type] = self.encoder.project(msg)
                 for output in ['stderr', 'stdout']:
                     if output in payload[msg_type]:
                         # only keep the last 1000 characters
@@ -129,4 +506,5 @@ class CallbackModule(object):
                             payload[msg_type][output] = "(clipping) ... " \
                                     + payload[msg_type][output][-1000:]
 
-            self.sqs.send_message(self.queue, json.dumps(payload))
+            for body in self.encoder.encode(payload):
+                self.publisher.publish(body)
@@ -0,0 +1,31 @@
+# (c) 2012, Peter Sankauskas
+#
+# This file is part of Ansible,
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+######################################################################
+
+'''
+EC2 external inventory for Ansible.
+
+The playbooks/ec2.py scripts are thin entry points around this package.
+It can also be imported without side effects:
+
+    from ec2_inventory import build_inventory
+    inventory = build_inventory('/path/to/ec2.ini')
+    inventory.groups['tag_play_edxapp']
+'''
+
+from .inventory import Ec2Inventory, Inventory, build_inventory
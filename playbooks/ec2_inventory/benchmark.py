@@ -0,0 +1,496 @@
+'''
+Benchmarks of the inventory, run from the playbooks directory with:
+
+    python -m ec2_inventory.benchmark add-instance [--instances 10000]
+    python -m ec2_inventory.benchmark fleet [--sizes 100,1000,10000,50000]
+    python -m ec2_inventory.benchmark streaming [--instances 300]
+
+add-instance times the grouping of synthetic instances in process. fleet
+records the responses of a synthetic AWS account of each size as replay
+fixtures, then times ec2.py refreshing the cache from them, --list and
+--host in separate processes, along with their peak memory. streaming
+checks that --list gives the same output, byte for byte, in streaming
+mode with pages smaller than a region as in a serial run.
+'''
+
+import os
+import sys
+import bisect
+import shutil
+import argparse
+import tempfile
+import subprocess
+from random import Random
+from time import time
+from xml.sax.saxutils import escape
+import ConfigParser
+
+from boto.ec2.instance import Instance
+from boto.ec2.securitygroup import GroupOrCIDR
+from boto.route53.connection import Route53Connection
+
+from .inventory import Ec2Inventory
+from .replay import FixtureResponse
+
+
+REGIONS = ['us-east-1', 'us-west-1', 'us-west-2', 'eu-west-1']
+INSTANCE_TYPES = ['m1.small', 'm1.large', 'm3.medium', 'c1.medium', 'c3.xlarge']
+ENVIRONMENTS = ['prod', 'stage', 'loadtest', 'sandbox']
+DEPLOYMENTS = ['edx', 'edge', 'mckinsey']
+PLAYS = ['edxapp', 'forum', 'xqueue', 'ora', 'worker', 'rabbitmq',
+         'elasticsearch', 'notifier', 'certs', 'jenkins']
+
+
+def benchmark_config(cache_path, **options):
+    ''' Returns the ConfigParser of a minimal ec2.ini that makes no API
+    calls while it is read, with the given options added '''
+
+    config = ConfigParser.SafeConfigParser()
+    config.add_section('ec2')
+    settings = {
+        'regions': ','.join(REGIONS),
+        'regions_exclude': '',
+        'destination_variable': 'public_dns_name',
+        'vpc_destination_variable': 'private_ip_address',
+        'route53': 'False',
+        'cache_path': cache_path,
+        'cache_max_age': '300',
+    }
+    settings.update(options)
+    for option, value in settings.iteritems():
+        config.set('ec2', option, str(value))
+    return config
+
+
+def synthetic_instance(number, random, region=None):
+    ''' Returns a boto Instance with the attributes and tags of one of our
+    running instances '''
+
+    region = region or REGIONS[number % len(REGIONS)]
+    environment = random.choice(ENVIRONMENTS)
+    deployment = random.choice(DEPLOYMENTS)
+    play = random.choice(PLAYS)
+
+    instance = Instance()
+    instance.id = 'i-%08x' % number
+    instance._state.name = 'running'
+    instance._state.code = 16
+    instance._placement.zone = region + random.choice('abc')
+    instance.instance_type = random.choice(INSTANCE_TYPES)
+    instance.image_id = 'ami-%08x' % random.randint(0, 64)
+    instance.key_name = 'deployment'
+    instance.launch_time = '2014-04-25T12:00:00.000Z'
+    instance.subnet_id = 'subnet-%08x' % random.randint(0, 32)
+    instance.vpc_id = 'vpc-%08x' % random.randint(0, 4)
+    instance.private_ip_address = '10.%d.%d.%d' % (
+        number >> 16 & 255, number >> 8 & 255, number & 255)
+    instance.private_dns_name = 'ip-%s.ec2.internal' % (
+        instance.private_ip_address.replace('.', '-'))
+    instance.tags = {
+        'Name': '%s-%s-%s' % (environment, deployment, play),
+        'environment': environment,
+        'deployment': deployment,
+        'play': play,
+        'aws:cloudformation:stack-name': '%s-%s' % (environment, deployment),
+    }
+
+    group = GroupOrCIDR()
+    group.id = 'sg-%08x' % PLAYS.index(play)
+    group.name = '%s-%s-%sSecurityGroup' % (environment, deployment,
+                                            play.capitalize())
+    instance.groups = [group]
+    return instance
+
+
+def synthetic_fleet(count, seed=0):
+    ''' Returns count synthetic instances as (region, instance) pairs '''
+
+    random = Random(seed)
+    fleet = []
+    for number in xrange(count):
+        instance = synthetic_instance(number, random)
+        fleet.append((instance.placement[:-1], instance))
+    return fleet
+
+
+def bench_add_instance(count, repeat):
+    ''' Times grouping count synthetic instances with add_instance, which
+    includes to_safe and the host variables of every instance '''
+
+    fleet = synthetic_fleet(count)
+    config = benchmark_config(tempfile.gettempdir())
+
+    timings = []
+    for _ in xrange(repeat):
+        inventory = Ec2Inventory(config)
+        start = time()
+        for region, instance in fleet:
+            inventory.add_instance(instance, region)
+        timings.append(time() - start)
+
+    best = min(timings)
+    print "add_instance x {}: best {:.3f}s of {} ({:.1f} us/instance, " \
+          "{} groups)".format(count, best, repeat, best / count * 1e6,
+                              len(inventory.inventory))
+
+
+class SyntheticAWS(object):
+    ''' Answers the EC2, RDS and Route53 requests of the inventory with
+    the XML AWS would send for a synthetic fleet. Used as the upstream of a
+    recording inventory, see replay.FixtureConnection '''
+
+    # Record sets returned by Route53 when no page size is asked for, EC2
+    # returns every item unless MaxResults is given
+    ROUTE53_PAGE_SIZE = 100
+
+    ZONE_ID = 'Z1BENCHMARK'
+    ZONE_NAME = 'benchmark.example.com.'
+
+    def __init__(self, fleet):
+        self.instances = {}
+        for region, instance in fleet:
+            self.instances.setdefault(region, []).append(instance)
+
+        # One database per 500 instances of a region
+        self.databases = {}
+        for region, instances in self.instances.iteritems():
+            self.databases[region] = [
+                '%s-db-%d' % (region, number)
+                for number in range(max(1, len(instances) / 500))]
+
+        # Every fourth instance has a name in the zone
+        self.records = sorted(
+            ('%s-%s.%s' % (instance.tags['play'], instance.id, self.ZONE_NAME),
+             'A', instance.private_ip_address)
+            for region, instance in fleet[::4])
+
+    def __call__(self, conn, *args, **kwargs):
+        if isinstance(conn, Route53Connection):
+            path = args[1]
+            params = kwargs.get('params') or {}
+            if path.endswith('/hostedzone'):
+                body = self.list_hosted_zones()
+            else:
+                body = self.list_resource_record_sets(params)
+        else:
+            action, params = args[0], args[1]
+            region = conn.region.name
+            body = {
+                'DescribeInstances': self.describe_instances,
+                'DescribeInstanceStatus': self.describe_instance_status,
+                'DescribeDBInstances': self.describe_db_instances,
+            }[action](region, params)
+
+        return FixtureResponse(200, 'OK', body)
+
+    def page(self, items, params):
+        ''' Returns the items of the page asked for by MaxResults and
+        NextToken, and the token of the next page '''
+
+        ids = [value for name, value in params.iteritems()
+               if name.startswith('InstanceId.')]
+        if ids:
+            return [item for item in items if item.id in ids], None
+
+        start = int(params.get('NextToken', 0))
+        end = start + int(params.get('MaxResults', len(items)))
+        if end >= len(items):
+            return items[start:], None
+        return items[start:end], str(end)
+
+    def describe_instances(self, region, params):
+        instances, next_token = self.page(
+            self.instances.get(region, []), params)
+
+        reservations = []
+        for instance in instances:
+            reservations.append(
+                '<item><reservationId>r-%s</reservationId>'
+                '<ownerId>123456789012</ownerId><groupSet/>'
+                '<instancesSet>%s</instancesSet></item>' % (
+                    instance.id[2:], self.render_instance(instance)))
+
+        return ('<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2013-10-15/">'
+                '<requestId>benchmark</requestId>'
+                '<reservationSet>%s</reservationSet>%s'
+                '</DescribeInstancesResponse>' % (
+                    ''.join(reservations), self.render_token(next_token)))
+
+    def render_instance(self, instance):
+        fields = [('instanceId', instance.id),
+                  ('imageId', instance.image_id),
+                  ('privateDnsName', instance.private_dns_name),
+                  ('dnsName', ''),
+                  ('keyName', instance.key_name),
+                  ('instanceType', instance.instance_type),
+                  ('launchTime', instance.launch_time),
+                  ('subnetId', instance.subnet_id),
+                  ('vpcId', instance.vpc_id),
+                  ('privateIpAddress', instance.private_ip_address)]
+
+        groups = ''.join(
+            '<item><groupId>%s</groupId><groupName>%s</groupName></item>' % (
+                escape(group.id), escape(group.name))
+            for group in instance.groups)
+        tags = ''.join(
+            '<item><key>%s</key><value>%s</value></item>' % (
+                escape(key), escape(value))
+            for key, value in sorted(instance.tags.iteritems()))
+
+        return ('<item>%s<instanceState><code>16</code><name>running</name>'
+                '</instanceState><placement><availabilityZone>%s'
+                '</availabilityZone><tenancy>default</tenancy></placement>'
+                '<groupSet>%s</groupSet><tagSet>%s</tagSet></item>' % (
+                    ''.join('<%s>%s</%s>' % (name, escape(value), name)
+                            for name, value in fields),
+                    instance.placement, groups, tags))
+
+    def render_token(self, next_token):
+        if next_token:
+            return '<nextToken>%s</nextToken>' % next_token
+        return ''
+
+    def describe_instance_status(self, region, params):
+        instances, next_token = self.page(
+            self.instances.get(region, []), params)
+
+        statuses = ''.join(
+            '<item><instanceId>%s</instanceId><availabilityZone>%s'
+            '</availabilityZone><instanceState><code>16</code>'
+            '<name>running</name></instanceState></item>' % (
+                instance.id, instance.placement)
+            for instance in instances)
+
+        return ('<DescribeInstanceStatusResponse xmlns="http://ec2.amazonaws.com/doc/2013-10-15/">'
+                '<requestId>benchmark</requestId>'
+                '<instanceStatusSet>%s</instanceStatusSet>%s'
+                '</DescribeInstanceStatusResponse>' % (
+                    statuses, self.render_token(next_token)))
+
+    def describe_db_instances(self, region, params):
+        databases = ''.join(
+            '<DBInstance><DBInstanceIdentifier>%(name)s</DBInstanceIdentifier>'
+            '<DBInstanceStatus>available</DBInstanceStatus>'
+            '<Engine>mysql</Engine><DBInstanceClass>db.m1.large</DBInstanceClass>'
+            '<AvailabilityZone>%(region)sa</AvailabilityZone>'
+            '<Endpoint><Address>%(name)s.rds.amazonaws.com</Address>'
+            '<Port>3306</Port></Endpoint>'
+            '<DBParameterGroups><DBParameterGroup>'
+            '<DBParameterGroupName>default.mysql5.6</DBParameterGroupName>'
+            '<ParameterApplyStatus>in-sync</ParameterApplyStatus>'
+            '</DBParameterGroup></DBParameterGroups>'
+            '<DBSecurityGroups><DBSecurityGroup>'
+            '<DBSecurityGroupName>default</DBSecurityGroupName>'
+            '<Status>active</Status></DBSecurityGroup></DBSecurityGroups>'
+            '</DBInstance>' % {'name': name, 'region': region}
+            for name in self.databases.get(region, []))
+
+        return ('<DescribeDBInstancesResponse xmlns="http://rds.amazonaws.com/doc/2013-05-15/">'
+                '<DescribeDBInstancesResult><DBInstances>%s</DBInstances>'
+                '</DescribeDBInstancesResult><ResponseMetadata>'
+                '<RequestId>benchmark</RequestId></ResponseMetadata>'
+                '</DescribeDBInstancesResponse>' % databases)
+
+    def list_hosted_zones(self):
+        return ('<ListHostedZonesResponse xmlns="https://route53.amazonaws.com/doc/2012-02-29/">'
+                '<HostedZones><HostedZone><Id>/hostedzone/%s</Id>'
+                '<Name>%s</Name><CallerReference>benchmark</CallerReference>'
+                '<Config/><ResourceRecordSetCount>%d</ResourceRecordSetCount>'
+                '</HostedZone></HostedZones><IsTruncated>false</IsTruncated>'
+                '<MaxItems>100</MaxItems></ListHostedZonesResponse>' % (
+                    self.ZONE_ID, self.ZONE_NAME, len(self.records)))
+
+    def list_resource_record_sets(self, params):
+        start = 0
+        if params.get('name'):
+            start = bisect.bisect_left(
+                self.records, (params['name'], params.get('type') or ''))
+        end = start + int(params.get('maxitems') or self.ROUTE53_PAGE_SIZE)
+
+        record_sets = ''.join(
+            '<ResourceRecordSet><Name>%s</Name><Type>%s</Type><TTL>300</TTL>'
+            '<ResourceRecords><ResourceRecord><Value>%s</Value>'
+            '</ResourceRecord></ResourceRecords></ResourceRecordSet>' % record
+            for record in self.records[start:end])
+
+        if end < len(self.records):
+            name, rrtype = self.records[end][:2]
+            truncated = ('<IsTruncated>true</IsTruncated>'
+                         '<NextRecordName>%s</NextRecordName>'
+                         '<NextRecordType>%s</NextRecordType>' % (name, rrtype))
+        else:
+            truncated = '<IsTruncated>false</IsTruncated>'
+
+        return ('<ListResourceRecordSetsResponse xmlns="https://route53.amazonaws.com/doc/2012-02-29/">'
+                '<ResourceRecordSets>%s</ResourceRecordSets>%s'
+                '<MaxItems>100</MaxItems></ListResourceRecordSetsResponse>' % (
+                    record_sets, truncated))
+
+
+def record_fleet(count, fixtures, options):
+    ''' Records the API responses for a synthetic fleet of count instances
+    as fixtures, returns the name of one of its hosts '''
+
+    fleet = synthetic_fleet(count)
+    cache_path = tempfile.mkdtemp()
+    try:
+        config = benchmark_config(cache_path, replay_fixtures=fixtures,
+                                  replay_mode='record', **options)
+        inventory = Ec2Inventory(config, refresh_cache=True)
+        inventory.replay_upstream = SyntheticAWS(fleet)
+        inventory.update()
+    finally:
+        shutil.rmtree(cache_path)
+
+    return fleet[count / 2][1].private_ip_address
+
+
+def run_inventory(inifile, *args):
+    ''' Runs ec2.py in a separate process, returns its wall clock time and
+    peak resident memory in MB '''
+
+    script = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'ec2.py')
+    command = [sys.executable, script, '--inifile', inifile] + list(args)
+
+    with open(os.devnull, 'w') as devnull:
+        start = time()
+        process = subprocess.Popen(command, stdout=devnull)
+        # wait4 gives the resource usage of this process alone
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time() - start
+    process.returncode = status
+
+    if status:
+        print "%s failed with status %d" % (' '.join(command), status)
+        sys.exit(1)
+
+    return elapsed, usage.ru_maxrss / 1024.0
+
+
+def list_inventory(count, workdir, options):
+    ''' Returns the output of ec2.py --list for a replayed synthetic
+    fleet of count instances '''
+
+    fixtures = os.path.join(workdir, 'fixtures')
+    record_fleet(count, fixtures, options)
+
+    config = benchmark_config(workdir, replay_fixtures=fixtures,
+                              replay_mode='replay', **options)
+    inifile = os.path.join(workdir, 'ec2.ini')
+    with open(inifile, 'w') as ini:
+        config.write(ini)
+
+    script = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'ec2.py')
+    return subprocess.check_output(
+        [sys.executable, script, '--inifile', inifile, '--refresh-cache'])
+
+
+def check_streaming(count, options):
+    ''' Compares the --list output of streaming mode with that of a serial
+    run, pages hold a third of the instances of a region '''
+
+    page_size = max(1, count / len(REGIONS) / 3)
+    outputs = {}
+    for mode, mode_options in [
+            ('serial', {}),
+            ('streaming', {'streaming': 'True',
+                           'streaming_page_size': page_size})]:
+        workdir = tempfile.mkdtemp()
+        try:
+            mode_options.update(options)
+            outputs[mode] = list_inventory(count, workdir, mode_options)
+        finally:
+            shutil.rmtree(workdir)
+
+    if outputs['serial'] != outputs['streaming']:
+        print "streaming --list differs from a serial run: %d bytes, " \
+              "%d expected" % (len(outputs['streaming']),
+                               len(outputs['serial']))
+        sys.exit(1)
+    print "streaming --list of %d hosts in pages of %d matches a serial " \
+          "run (%d bytes)" % (count, page_size, len(outputs['serial']))
+
+
+def bench_fleet(sizes, repeat, options):
+    ''' Times refreshing the cache, --list and --host against replayed
+    synthetic fleets of each size '''
+
+    print "{:>8} {:>11} {:>11} {:>11} {:>10}".format(
+        'hosts', 'refresh s', '--list s', '--host s', 'peak MB')
+
+    for count in sizes:
+        workdir = tempfile.mkdtemp()
+        try:
+            fixtures = os.path.join(workdir, 'fixtures')
+            host = record_fleet(count, fixtures, options)
+
+            config = benchmark_config(workdir, replay_fixtures=fixtures,
+                                      replay_mode='replay',
+                                      cache_max_age=86400, **options)
+            inifile = os.path.join(workdir, 'ec2.ini')
+            with open(inifile, 'w') as ini:
+                config.write(ini)
+
+            runs = {'refresh': [], 'list': [], 'host': []}
+            peak = 0
+            for _ in xrange(repeat):
+                for name, args in [('refresh', ['--refresh-cache']),
+                                   ('list', ['--list']),
+                                   ('host', ['--host', host])]:
+                    elapsed, rss = run_inventory(inifile, *args)
+                    runs[name].append(elapsed)
+                    peak = max(peak, rss)
+
+            print "{:>8} {:>11.3f} {:>11.3f} {:>11.3f} {:>10.1f}".format(
+                count, min(runs['refresh']), min(runs['list']),
+                min(runs['host']), peak)
+        finally:
+            shutil.rmtree(workdir)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the EC2 inventory')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    add_instance = subparsers.add_parser(
+        'add-instance', help='time grouping synthetic instances in process')
+    add_instance.add_argument('--instances', type=int, default=10000,
+                              help='number of synthetic instances (default: 10000)')
+    add_instance.add_argument('--repeat', type=int, default=3,
+                              help='number of timed runs, the best is reported')
+
+    fleet = subparsers.add_parser(
+        'fleet', help='time ec2.py against replayed synthetic fleets')
+    fleet.add_argument('--sizes', default='100,1000,10000,50000',
+                       help='comma separated fleet sizes (default: 100,1000,10000,50000)')
+    fleet.add_argument('--repeat', type=int, default=3,
+                       help='number of timed runs, the best is reported')
+    fleet.add_argument('--option', action='append', default=[],
+                       metavar='NAME=VALUE',
+                       help='ec2.ini option to benchmark with, e.g. streaming=True')
+
+    streaming = subparsers.add_parser(
+        'streaming', help='check streaming --list against a serial run')
+    streaming.add_argument('--instances', type=int, default=300,
+                           help='number of synthetic instances (default: 300)')
+    streaming.add_argument('--option', action='append', default=[],
+                           metavar='NAME=VALUE',
+                           help='ec2.ini option of both runs, e.g. route53=True')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.benchmark == 'add-instance':
+        bench_add_instance(args.instances, args.repeat)
+    else:
+        options = {'rds': 'True', 'route53': 'True'}
+        options.update(option.split('=', 1) for option in args.option)
+        if args.benchmark == 'streaming':
+            check_streaming(args.instances, options)
+        else:
+            bench_fleet([int(size) for size in args.sizes.split(',')],
+                        args.repeat, options)
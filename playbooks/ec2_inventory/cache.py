@@ -0,0 +1,259 @@
+# (c) 2012, Peter Sankauskas
+#
+# This file is part of Ansible,
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+######################################################################
+
+'''
+Cache file formats and compact in-memory storage used by the EC2 inventory
+'''
+
+import os
+import mmap
+import struct
+from array import array
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class BinaryCache(object):
+    ''' Compact on-disk map of string keys to JSON values.
+
+    The file starts with a header and a table of fixed size entries sorted by
+    key, followed by the key and value bytes. The file is memory-mapped and a
+    single key is found with a binary search over the table, so looking up one
+    host or group does not read or parse the rest of the file. '''
+
+    MAGIC = 'AEC2BIN1'
+    HEADER = struct.Struct('<8sI')
+    ENTRY = struct.Struct('<IIII')
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as cache:
+            self.data = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count = self.HEADER.unpack_from(self.data, 0)
+        if magic != self.MAGIC:
+            raise ValueError("%s is not a binary inventory cache" % filename)
+
+
+    @classmethod
+    def write(cls, data, filename):
+        ''' Writes a dict to filename, replacing it atomically so readers
+        never map a partially written file '''
+
+        items = sorted((key.encode('utf-8'), json.dumps(value))
+                       for key, value in data.iteritems())
+
+        offset = cls.HEADER.size + cls.ENTRY.size * len(items)
+        table = []
+        blob = []
+        for key, value in items:
+            table.append(cls.ENTRY.pack(offset, len(key),
+                                        offset + len(key), len(value)))
+            blob.append(key)
+            blob.append(value)
+            offset += len(key) + len(value)
+
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as cache:
+            cache.write(cls.HEADER.pack(cls.MAGIC, len(items)))
+            cache.write(''.join(table))
+            cache.write(''.join(blob))
+        os.rename(tmp_filename, filename)
+
+
+    def entry(self, position):
+        ''' Returns the (key, value offset, value length) of a table entry '''
+
+        key_offset, key_len, value_offset, value_len = self.ENTRY.unpack_from(
+            self.data, self.HEADER.size + self.ENTRY.size * position)
+        return self.data[key_offset:key_offset + key_len], value_offset, value_len
+
+
+    def get(self, key, default=None):
+        ''' Returns the value stored for key without reading other entries '''
+
+        key = key.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            middle_key, value_offset, value_len = self.entry(middle)
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return json.loads(self.data[value_offset:value_offset + value_len])
+        return default
+
+
+    def iteritems(self):
+        ''' Yields every (key, value) pair in key order '''
+
+        for position in xrange(self.count):
+            key, value_offset, value_len = self.entry(position)
+            yield (key.decode('utf-8'),
+                   json.loads(self.data[value_offset:value_offset + value_len]))
+
+
+class InventoryGroups(object):
+    ''' Compact replacement for the dict of group name to list of hosts.
+
+    Each host name is stored once and groups hold arrays of integer host
+    IDs, so a group membership costs a machine integer instead of a list
+    slot pointing at a string. '''
+
+    def __init__(self):
+        self.hosts = []
+        self.host_ids = {}
+        self.groups = {}
+
+
+    def host_id(self, host):
+        ''' Returns the integer ID of a host, storing new host names once '''
+
+        host_id = self.host_ids.get(host)
+        if host_id is None:
+            host_id = self.host_ids[host] = len(self.hosts)
+            self.hosts.append(host)
+        return host_id
+
+
+    def push(self, key, host):
+        if key not in self.groups:
+            self.groups[key] = array('l')
+        self.groups[key].append(self.host_id(host))
+
+
+    def __setitem__(self, key, hosts):
+        self.groups[key] = array('l', [self.host_id(host) for host in hosts])
+
+
+    def __getitem__(self, key):
+        return [self.hosts[host_id] for host_id in self.groups[key]]
+
+
+    def __contains__(self, key):
+        return key in self.groups
+
+
+    def __len__(self):
+        return len(self.groups)
+
+
+    def keys(self):
+        return self.groups.keys()
+
+
+    def iteritems(self):
+        for key in self.groups:
+            yield key, self[key]
+
+
+class CompactDict(object):
+    ''' Dict of JSON values kept as compact JSON strings and decoded on
+    access, used for the host variables of large fleets '''
+
+    def __init__(self):
+        self.data = {}
+
+
+    def __setitem__(self, key, value):
+        self.data[key] = json.dumps(value, separators=(',', ':'))
+
+
+    def __getitem__(self, key):
+        return json.loads(self.data[key])
+
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def get(self, key, default=None):
+        if key in self.data:
+            return self[key]
+        return default
+
+
+    def update(self, other):
+        for key, value in other.iteritems():
+            self[key] = value
+
+
+    def keys(self):
+        return self.data.keys()
+
+
+    def iteritems(self):
+        for key in self.data:
+            yield key, self[key]
+
+
+class StreamedObject(object):
+    ''' A JSON object given as (key, value) pairs already sorted by key, for
+    JsonStreamWriter '''
+
+    def __init__(self, items):
+        self.items = items
+
+
+class JsonStreamWriter(object):
+    ''' Writes the same text as json.dumps(data, sort_keys=True, indent=2)
+    one entry at a time, so the whole document is never held in memory '''
+
+    def __init__(self, stream):
+        self.stream = stream
+
+
+    def write(self, items, level=0):
+        ''' Writes a JSON object from (key, value) pairs sorted by key.
+        Values can be StreamedObjects themselves '''
+
+        indent = '\n' + '  ' * (level + 1)
+        first = True
+        for key, value in items:
+            self.stream.write('{' if first else ', ')
+            self.stream.write(indent + json.dumps(key) + ': ')
+            first = False
+            if isinstance(value, StreamedObject):
+                self.write(value.items, level + 1)
+            else:
+                # Nested values are rendered on their own and shifted to
+                # this level, JSON strings never contain raw newlines
+                self.stream.write(json.dumps(value, sort_keys=True, indent=2)
+                                  .replace('\n', indent))
+
+        if first:
+            self.stream.write('{}')
+        else:
+            self.stream.write('\n' + '  ' * level + '}')
+
+
+    @staticmethod
+    def sorted_items(data):
+        ''' Yields the (key, value) pairs of a mapping sorted by key '''
+
+        for key in sorted(data.keys()):
+            yield key, data[key]
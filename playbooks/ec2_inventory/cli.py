@@ -0,0 +1,52 @@
+'''
+Command line entry point of the EC2 inventory, used by the ec2.py scripts
+'''
+
+import os
+import sys
+import argparse
+
+from .inventory import Ec2Inventory
+from .profiling import Profiler
+
+
+def parse_cli_args(default_inifile, argv=None):
+    ''' Command line argument processing '''
+
+    parser = argparse.ArgumentParser(description='Produce an Ansible Inventory file based on EC2')
+    parser.add_argument('--tags-only', action='store_true', default=False,
+                       help='only return tags (default: False)')
+    parser.add_argument('--list', action='store_true', default=True,
+                       help='List instances (default: True)')
+    parser.add_argument('--host', action='store',
+                       help='Get all the variables about a specific instance')
+    parser.add_argument('--refresh-cache', action='store_true', default=False,
+                       help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
+    parser.add_argument('--profile', action='store_true', default=False,
+                       help='Report the time spent in API calls, grouping, serialization and cache I/O on stderr')
+
+    default_inifile = os.environ.get("ANSIBLE_EC2_INI", default_inifile)
+
+    parser.add_argument('--inifile', dest='inifile', help='Path to init script to use', default=default_inifile)
+    return parser.parse_args(argv)
+
+
+def main(default_inifile, argv=None):
+    ''' Prints the --list or --host output for the given arguments '''
+
+    args = parse_cli_args(default_inifile, argv)
+    profiler = Profiler() if args.profile else None
+
+    inventory = Ec2Inventory(args.inifile, refresh_cache=args.refresh_cache,
+                             tags_only=args.tags_only, profiler=profiler)
+    inventory.update()
+
+    # Data to print
+    if args.host:
+        print inventory.get_host_info(args.host)
+    elif args.list:
+        # Display list of instances for inventory
+        inventory.write_list(sys.stdout)
+
+    if profiler:
+        profiler.report(sys.stderr)
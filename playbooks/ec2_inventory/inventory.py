@@ -0,0 +1,1179 @@
+# (c) 2012, Peter Sankauskas
+#
+# This file is part of Ansible,
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+######################################################################
+
+'''
+EC2 inventory builder, see playbooks/ec2.py for the variables it provides
+'''
+
+import sys
+import os
+import re
+import string
+import hashlib
+import shutil
+import threading
+import Queue
+from time import time
+import boto
+from boto import ec2
+from boto.ec2.instance import Reservation
+from boto.resultset import ResultSet
+import ConfigParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from .cache import BinaryCache, InventoryGroups, CompactDict, \
+    StreamedObject, JsonStreamWriter
+from .profiling import NullProfiler
+
+
+# to_safe() keeps these characters and replaces every other one with '_'
+SAFE_CHARS = string.ascii_letters + string.digits + '-'
+SAFE_TABLE = ''.join(c if c in SAFE_CHARS else '_'
+                     for c in map(chr, range(256)))
+UNSAFE_RE = re.compile("[^A-Za-z0-9\-]")
+
+# Number of sanitized group names remembered by to_safe()
+SAFE_CACHE_SIZE = 10000
+
+
+class ReservationSet(ResultSet):
+    ''' A page of DescribeInstances reservations. boto's ResultSet only
+    reads the NextToken of the query APIs, EC2 sends nextToken '''
+
+    def __init__(self, connection=None):
+        ResultSet.__init__(self, [('item', Reservation)])
+
+    def endElement(self, name, value, connection):
+        if name == 'nextToken':
+            self.next_token = value
+        else:
+            ResultSet.endElement(self, name, value, connection)
+
+
+class Ec2Inventory(object):
+    ''' Builds the inventory of EC2 and RDS instances, caching the results
+    of the API calls. Nothing is fetched until update() is called '''
+
+    def __init__(self, config, refresh_cache=False, tags_only=False,
+                 profiler=None):
+        ''' config is the path of an ec2.ini file or a ConfigParser '''
+
+        # Inventory grouped by instance IDs, tags, security groups, regions,
+        # and availability zones
+        self.inventory = {}
+
+        # Index of hostname (address) to instance ID
+        self.index = {}
+
+        # Variables of each host, served by --host and under _meta in --list
+        self.hostvars = {}
+
+        # Group names already sanitized by to_safe()
+        self.safe_words = {}
+
+        self.refresh_cache = refresh_cache
+        self.tags_only = tags_only
+        self.profiler = profiler or NullProfiler()
+
+        self.read_settings(config)
+
+        if self.streaming:
+            self.inventory = InventoryGroups()
+            self.hostvars = CompactDict()
+
+
+    def update(self):
+        ''' Makes the API calls and rewrites the cache files if they were
+        asked to be refreshed or have expired '''
+
+        if self.refresh_cache:
+            self.do_api_calls_update_cache()
+        elif not self.is_cache_valid():
+            self.do_api_calls_update_cache()
+
+
+    def write_list(self, stream):
+        ''' Writes the --list JSON output to stream '''
+
+        if self.streaming and self.cache_format == 'json' and \
+                not self.tags_only:
+            # The cache file was written incrementally, copy it out
+            # instead of rendering the inventory a second time
+            with self.profiler.section('cache io'):
+                with open(self.cache_path_cache, 'r') as cache:
+                    shutil.copyfileobj(cache, stream)
+            stream.write('\n')
+            return
+
+        if len(self.inventory) == 0:
+            data = self.get_inventory_from_cache()
+        else:
+            with self.profiler.section('serialization'):
+                if self.tags_only:
+                    data = self.json_format_dict(self.get_tag_groups(), True)
+                else:
+                    data = self.json_format_dict(
+                        self.get_inventory_with_hostvars(), True)
+        stream.write(data + '\n')
+
+
+    def get_inventory(self):
+        ''' Returns the groups, index and host variables as an Inventory,
+        reading them from the cache files if they are not in memory '''
+
+        if len(self.inventory) == 0:
+            with self.profiler.section('cache io'):
+                if self.cache_format == 'binary':
+                    groups = dict(BinaryCache(self.cache_path_cache).iteritems())
+                    index = dict(BinaryCache(self.cache_path_index).iteritems())
+                else:
+                    with open(self.cache_path_cache, 'r') as cache:
+                        groups = json.loads(cache.read())
+                    self.load_index_from_cache()
+                    index = self.index
+            hostvars = groups.pop('_meta', {}).get('hostvars', {})
+            return Inventory(groups, index, hostvars)
+
+        return Inventory(dict(self.inventory.iteritems()), dict(self.index),
+                         dict(self.hostvars.iteritems()))
+
+
+    def is_cache_valid(self):
+        ''' Determines if the cache files have expired, or if it is still valid '''
+
+        if self.tags_only:
+            to_check = self.cache_path_tags
+        else:
+            to_check = self.cache_path_cache
+
+        if os.path.isfile(to_check):
+            mod_time = os.path.getmtime(to_check)
+            current_time = time()
+            if (mod_time + self.cache_max_age) > current_time:
+                if os.path.isfile(self.cache_path_index):
+                    return True
+
+        return False
+
+
+    def read_settings(self, config):
+        ''' Reads the settings from the ec2.ini file '''
+
+        if isinstance(config, basestring):
+            inifile = config
+            config = ConfigParser.SafeConfigParser()
+            config.read(inifile)
+
+        # is eucalyptus?
+        self.eucalyptus_host = None
+        self.eucalyptus = False
+        if config.has_option('ec2', 'eucalyptus'):
+            self.eucalyptus = config.getboolean('ec2', 'eucalyptus')
+        if self.eucalyptus and config.has_option('ec2', 'eucalyptus_host'):
+            self.eucalyptus_host = config.get('ec2', 'eucalyptus_host')
+
+        # Regions
+        self.regions = []
+        configRegions = config.get('ec2', 'regions')
+        configRegions_exclude = config.get('ec2', 'regions_exclude')
+        if (configRegions == 'all'):
+            if self.eucalyptus_host:
+                self.regions.append(boto.connect_euca(host=self.eucalyptus_host).region.name)
+            else:
+                for regionInfo in ec2.regions():
+                    if regionInfo.name not in configRegions_exclude:
+                        self.regions.append(regionInfo.name)
+        else:
+            self.regions = configRegions.split(",")
+
+        # Destination addresses
+        self.destination_variable = config.get('ec2', 'destination_variable')
+        self.vpc_destination_variable = config.get('ec2', 'vpc_destination_variable')
+
+        # Filters applied by the EC2 API when listing instances, only
+        # running instances are listed unless instance_states says otherwise
+        filter_options = [('instance_states', 'instance-state-name', 'running'),
+                          ('tag_keys', 'tag-key', ''),
+                          ('tag_values', 'tag-value', ''),
+                          ('vpc_ids', 'vpc-id', '')]
+        self.ec2_instance_filters = {}
+        for option, filter_name, default in filter_options:
+            if config.has_option('ec2', option):
+                values = self.split_option(config.get('ec2', option))
+            else:
+                values = self.split_option(default)
+            if values:
+                self.ec2_instance_filters[filter_name] = values
+
+        self.ec2_instance_ids = None
+        if config.has_option('ec2', 'instance_ids'):
+            self.ec2_instance_ids = self.split_option(
+                config.get('ec2', 'instance_ids')) or None
+
+        # RDS
+        self.rds_enabled = True
+        if config.has_option('ec2', 'rds'):
+            self.rds_enabled = config.getboolean('ec2', 'rds')
+
+        # Route53
+        self.route53_enabled = config.getboolean('ec2', 'route53')
+        self.route53_excluded_zones = []
+        if config.has_option('ec2', 'route53_excluded_zones'):
+            self.route53_excluded_zones.extend(
+                config.get('ec2', 'route53_excluded_zones', '').split(','))
+
+        # Cache related
+        cache_path = config.get('ec2', 'cache_path')
+        self.cache_format = 'json'
+        if config.has_option('ec2', 'cache_format'):
+            self.cache_format = config.get('ec2', 'cache_format')
+        if self.cache_format not in ('json', 'binary'):
+            print "cache_format must be one of json, binary"
+            sys.exit(1)
+        cache_suffix = '.bin' if self.cache_format == 'binary' else ''
+
+        self.cache_path_cache = cache_path + "/ansible-ec2.cache" + cache_suffix
+        self.cache_path_tags = cache_path + "/ansible-ec2.tags.cache"
+        self.cache_path_index = cache_path + "/ansible-ec2.index" + cache_suffix
+        self.cache_path_hostvars = cache_path + "/ansible-ec2.hostvars" + cache_suffix
+        self.cache_path_route53 = cache_path + "/ansible-ec2.route53"
+        self.cache_path_segment = cache_path + "/ansible-ec2.%s.segment"
+        self.cache_max_age = config.getint('ec2', 'cache_max_age')
+        self.route53_cache_max_age = 3600
+        if config.has_option('ec2', 'route53_cache_max_age'):
+            self.route53_cache_max_age = config.getint('ec2', 'route53_cache_max_age')
+
+        # Number of concurrent region fetches, 1 keeps the serial behaviour
+        self.fetch_workers = 1
+        if config.has_option('ec2', 'fetch_workers'):
+            self.fetch_workers = max(1, config.getint('ec2', 'fetch_workers'))
+
+        # Streaming build with compact group storage and incremental output
+        self.streaming = False
+        if config.has_option('ec2', 'streaming'):
+            self.streaming = config.getboolean('ec2', 'streaming')
+        self.streaming_page_size = 500
+        if config.has_option('ec2', 'streaming_page_size'):
+            self.streaming_page_size = config.getint('ec2', 'streaming_page_size')
+
+        # Incremental refresh from per-region cache segments
+        self.cache_incremental = False
+        if config.has_option('ec2', 'cache_incremental'):
+            self.cache_incremental = config.getboolean('ec2', 'cache_incremental')
+        self.cache_segment_max_age = 3600
+        if config.has_option('ec2', 'cache_segment_max_age'):
+            self.cache_segment_max_age = config.getint('ec2', 'cache_segment_max_age')
+
+        # Recorded API responses served instead of calling AWS, or recorded
+        # from AWS with replay_mode = record
+        self.replay_fixtures = None
+        if config.has_option('ec2', 'replay_fixtures'):
+            self.replay_fixtures = config.get('ec2', 'replay_fixtures') or None
+        self.replay_mode = 'replay'
+        if config.has_option('ec2', 'replay_mode'):
+            self.replay_mode = config.get('ec2', 'replay_mode')
+        if self.replay_mode not in ('record', 'replay'):
+            print "replay_mode must be one of record, replay"
+            sys.exit(1)
+
+        # Called instead of AWS when recording, see replay.FixtureConnection
+        self.replay_upstream = None
+
+
+    def split_option(self, value):
+        ''' Splits a comma separated ec2.ini option into a list '''
+
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+
+    def do_api_calls_update_cache(self):
+        ''' Do API calls to each region, and save data in cache files '''
+
+        if self.route53_enabled:
+            self.get_route53_records()
+
+        if self.cache_incremental:
+            self.update_regions_incrementally()
+        elif self.streaming:
+            # Regions are read in order, one page of reservations at a time
+            for region in self.regions:
+                self.stream_instances_by_region(region)
+                self.get_rds_instances_by_region(region)
+        elif self.fetch_workers > 1 and len(self.regions) > 1:
+            fetched = self.fetch_regions_concurrently(self.regions)
+
+            # Merge in the configured region order so the output is the
+            # same as a serial run
+            for region in self.regions:
+                for instance in fetched[(region, 'ec2')]:
+                    self.add_instance(instance, region)
+                for instance in fetched[(region, 'rds')]:
+                    self.add_rds_instance(instance, region)
+        else:
+            for region in self.regions:
+                self.get_instances_by_region(region)
+                self.get_rds_instances_by_region(region)
+
+        if self.tags_only:
+            self.write_to_cache(self.get_tag_groups(), self.cache_path_tags)
+        elif self.streaming and self.cache_format == 'json':
+            self.write_json_stream(self.iter_inventory_with_hostvars(),
+                                   self.cache_path_cache)
+        else:
+            self.write_keyed_cache(self.get_inventory_with_hostvars(),
+                                   self.cache_path_cache)
+
+        self.write_keyed_cache(self.index, self.cache_path_index)
+        self.write_keyed_cache(self.hostvars, self.cache_path_hostvars)
+
+    def get_tag_groups(self):
+        ''' Returns the names of the tag groups, the --list output of
+        --tags-only '''
+
+        return [group for group in self.inventory.keys() if 'tag_' in group]
+
+    def get_inventory_with_hostvars(self):
+        ''' Returns the inventory with the variables of every host under
+        _meta, so Ansible does not need to call --host for each host '''
+
+        inventory = dict(self.inventory.iteritems())
+        inventory['_meta'] = {'hostvars': dict(self.hostvars.iteritems())}
+        return inventory
+
+    def iter_inventory_with_hostvars(self):
+        ''' Yields the same data as get_inventory_with_hostvars as sorted
+        (key, value) pairs, building one group at a time '''
+
+        meta = StreamedObject([('hostvars', StreamedObject(
+            JsonStreamWriter.sorted_items(self.hostvars)))])
+
+        for key in sorted(self.inventory.keys() + ['_meta']):
+            if key == '_meta':
+                yield key, meta
+            else:
+                yield key, self.inventory[key]
+
+    def update_regions_incrementally(self):
+        ''' Rebuilds the inventory from the per-region cache segments, only
+        making the full API calls for regions whose segment expired or whose
+        fingerprint no longer matches '''
+
+        fingerprints = self.run_concurrently(
+            [(region, self.get_region_fingerprint, region)
+             for region in self.regions])
+
+        segments = {}
+        if not self.refresh_cache:
+            for region in self.regions:
+                segment = self.load_segment(region)
+                if segment and \
+                        segment['fetched'] + self.cache_segment_max_age > time() and \
+                        segment['fingerprint'] == fingerprints[region]:
+                    segments[region] = segment
+
+        stale = [region for region in self.regions if region not in segments]
+        if stale:
+            fetched = self.fetch_regions_concurrently(stale)
+            for region in stale:
+                segments[region] = self.build_segment(
+                    region, fetched[(region, 'ec2')], fetched[(region, 'rds')],
+                    fingerprints[region])
+                self.write_segment(region, segments[region])
+
+        for region in self.regions:
+            self.merge_segment(segments[region])
+
+    def build_segment(self, region, instances, rds_instances, fingerprint):
+        ''' Groups the instances of a single region into a cache segment '''
+
+        inventory, index, hostvars = self.inventory, self.index, self.hostvars
+        self.inventory, self.index, self.hostvars = {}, {}, {}
+        try:
+            for instance in instances:
+                self.add_instance(instance, region)
+            for instance in rds_instances:
+                self.add_rds_instance(instance, region)
+            segment = {
+                'fetched': time(),
+                'fingerprint': fingerprint,
+                'inventory': self.inventory,
+                'index': self.index,
+                'hostvars': self.hostvars,
+            }
+        finally:
+            self.inventory, self.index, self.hostvars = inventory, index, hostvars
+
+        return segment
+
+    def merge_segment(self, segment):
+        ''' Adds the groups and index of a region segment to the inventory '''
+
+        with self.profiler.section('grouping'):
+            self._merge_segment(segment)
+
+    def _merge_segment(self, segment):
+        for key, hosts in segment['inventory'].iteritems():
+            if key.startswith('first_in_'):
+                self.keep_first(self.inventory, key, hosts[0])
+            else:
+                for host in hosts:
+                    self.push(self.inventory, key, host)
+
+        self.index.update(segment['index'])
+        self.hostvars.update(segment.get('hostvars', {}))
+
+    def get_region_fingerprint(self, region):
+        ''' Makes a cheap AWS EC2 API call listing the IDs and states of the
+        running instances in a particular region '''
+
+        instances = []
+        try:
+            conn = self.connect_to_region(region)
+            next_token = None
+            while True:
+                with self.profiler.section('api fetch'):
+                    statuses = conn.get_all_instance_status(
+                        instance_ids=self.ec2_instance_ids, next_token=next_token)
+                instances.extend(
+                    (status.id, status.state_name) for status in statuses)
+                next_token = statuses.next_token
+                if not next_token:
+                    break
+
+        except boto.exception.BotoServerError as e:
+            if  not self.eucalyptus:
+                print "Looks like AWS is down again:"
+            print e
+            sys.exit(1)
+
+        return self.fingerprint(instances)
+
+    def fingerprint(self, instances):
+        ''' Hashes (instance ID, state) pairs regardless of their order '''
+
+        digest = hashlib.sha1()
+        for instance_id, state in sorted(instances):
+            digest.update("%s:%s\n" % (instance_id, state))
+        return digest.hexdigest()
+
+    def fetch_regions_concurrently(self, regions):
+        ''' Fetches the EC2 and RDS instances of the given regions. Returns a
+        dict keyed by (region, 'ec2') and (region, 'rds') '''
+
+        calls = []
+        for region in regions:
+            calls.append(((region, 'ec2'), self.fetch_instances_by_region, region))
+            calls.append(((region, 'rds'), self.fetch_rds_instances_by_region, region))
+
+        return self.run_concurrently(calls)
+
+    def run_concurrently(self, calls):
+        ''' Runs (key, function, argument) calls on a bounded pool of
+        worker threads and returns a dict of key to result '''
+
+        results = {}
+        if self.fetch_workers <= 1 or len(calls) <= 1:
+            for key, function, argument in calls:
+                results[key] = function(argument)
+            return results
+
+        pending = Queue.Queue()
+        for call in calls:
+            pending.put(call)
+
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    key, function, argument = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[key] = function(argument)
+                except BaseException as e:
+                    # sys.exit() in a thread only ends the thread, hand the
+                    # error back to the main thread instead
+                    errors.append(e)
+
+        workers = [threading.Thread(target=worker)
+                   for _ in range(min(self.fetch_workers, len(calls)))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        return results
+
+    def connect_to_region(self, region):
+        ''' Returns an EC2 connection for a particular region '''
+
+        if self.eucalyptus:
+            conn = boto.connect_euca(host=self.eucalyptus_host)
+            conn.APIVersion = '2010-08-31'
+        else:
+            conn = self.connect('ec2', region)
+
+        # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
+        if conn is None:
+            print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
+            sys.exit(1)
+
+        return conn
+
+    def connect(self, service, region=None):
+        ''' Returns a connection to ec2, rds or route53, which replays the
+        recorded responses instead of calling AWS if replay_fixtures is set '''
+
+        if self.replay_fixtures:
+            from .replay import FixtureStore, connect
+            return connect(service, region, FixtureStore(self.replay_fixtures),
+                           self.replay_mode, self.replay_upstream)
+
+        if service == 'ec2':
+            return ec2.connect_to_region(region)
+
+        # Only loaded when enabled, to keep the startup time down
+        if service == 'rds':
+            from boto import rds
+            return rds.connect_to_region(region)
+
+        from boto import route53
+        return route53.Route53Connection()
+
+    def stream_instances_by_region(self, region):
+        ''' Adds the instances in a particular region to the inventory as each
+        page of reservations arrives '''
+
+        try:
+            conn = self.connect_to_region(region)
+            for reservation in self.iter_reservations(conn):
+                for instance in sorted(reservation.instances):
+                    self.add_instance(instance, region)
+
+        except boto.exception.BotoServerError as e:
+            if  not self.eucalyptus:
+                print "Looks like AWS is down again:"
+            print e
+            sys.exit(1)
+
+    def iter_reservations(self, conn):
+        ''' Makes paginated AWS EC2 API calls to the list of reservations,
+        yielding them page by page '''
+
+        # Eucalyptus does not paginate and EC2 does not allow MaxResults
+        # together with instance IDs
+        if self.eucalyptus or self.ec2_instance_ids:
+            with self.profiler.section('api fetch'):
+                reservations = conn.get_all_instances(
+                    instance_ids=self.ec2_instance_ids,
+                    filters=self.ec2_instance_filters)
+            for reservation in reservations:
+                yield reservation
+            return
+
+        params = {'MaxResults': self.streaming_page_size}
+        if self.ec2_instance_filters:
+            conn.build_filter_params(params, self.ec2_instance_filters)
+
+        while True:
+            with self.profiler.section('api fetch'):
+                page = conn.get_object('DescribeInstances', dict(params),
+                                       ReservationSet, verb='POST')
+            for reservation in page:
+                yield reservation
+            if not page.next_token:
+                return
+            params['NextToken'] = page.next_token
+
+    def get_instances_by_region(self, region):
+        ''' Adds the instances in a particular region to the inventory '''
+
+        for instance in self.fetch_instances_by_region(region):
+            self.add_instance(instance, region)
+
+    def fetch_instances_by_region(self, region):
+        ''' Makes an AWS EC2 API call to the list of instances in a particular
+        region '''
+
+        instances = []
+        try:
+            conn = self.connect_to_region(region)
+            with self.profiler.section('api fetch'):
+                reservations = conn.get_all_instances(
+                    instance_ids=self.ec2_instance_ids,
+                    filters=self.ec2_instance_filters)
+            for reservation in reservations:
+                instances.extend(sorted(reservation.instances))
+
+        except boto.exception.BotoServerError as e:
+            if  not self.eucalyptus:
+                print "Looks like AWS is down again:"
+            print e
+            sys.exit(1)
+
+        return instances
+
+    def get_rds_instances_by_region(self, region):
+        ''' Adds the RDS instances in a particular region to the inventory '''
+
+        for instance in self.fetch_rds_instances_by_region(region):
+            self.add_rds_instance(instance, region)
+
+    def fetch_rds_instances_by_region(self, region):
+        ''' Makes an AWS API call to the list of RDS instances in a particular
+        region '''
+
+        if not self.rds_enabled:
+            return []
+
+        instances = []
+        try:
+            conn = self.connect('rds', region)
+            if conn:
+                with self.profiler.section('api fetch'):
+                    instances = conn.get_all_dbinstances()
+        except boto.exception.BotoServerError as e:
+            print "Looks like AWS RDS is down: "
+            print e
+            sys.exit(1)
+
+        return instances
+
+    def get_instance(self, region, instance_id):
+        ''' Gets details about a specific instance '''
+        conn = self.connect_to_region(region)
+
+        with self.profiler.section('api fetch'):
+            reservations = conn.get_all_instances([instance_id])
+        for reservation in reservations:
+            for instance in reservation.instances:
+                return instance
+
+
+    def add_instance(self, instance, region):
+        ''' Adds an instance to the inventory and index, as long as it is
+        addressable '''
+
+        with self.profiler.section('grouping'):
+            self._add_instance(instance, region)
+
+
+    def _add_instance(self, instance, region):
+        # Only want running instances
+        if instance.state != 'running':
+            return
+
+        # Select the best destination address
+        if instance.subnet_id:
+            dest = getattr(instance, self.vpc_destination_variable)
+        else:
+            dest =  getattr(instance, self.destination_variable)
+
+        if not dest:
+            # Skip instances we cannot address (e.g. private VPC subnet)
+            return
+
+        # Add to index
+        self.index[dest] = [region, instance.id]
+
+        # Keep the host variables so --host can be answered from the cache
+        self.hostvars[dest] = self.get_host_info_dict_from_instance(instance)
+
+        # Inventory: Group by instance ID (always a group of 1)
+        self.inventory[instance.id] = [dest]
+
+        # Inventory: Group by region
+        self.push(self.inventory, region, dest)
+
+        # Inventory: Group by availability zone
+        self.push(self.inventory, instance.placement, dest)
+
+        # Inventory: Group by instance type
+        self.push(self.inventory, self.to_safe('type_' + instance.instance_type), dest)
+
+        # Inventory: Group by key pair
+        if instance.key_name:
+            self.push(self.inventory, self.to_safe('key_' + instance.key_name), dest)
+
+        # Inventory: Group by security group
+        try:
+            for group in instance.groups:
+                key = self.to_safe("security_group_" + group.name)
+                self.push(self.inventory, key, dest)
+        except AttributeError:
+            print 'Package boto seems a bit older.'
+            print 'Please upgrade boto >= 2.3.0.'
+            sys.exit(1)
+
+        # Inventory: Group by tag keys
+        for k, v in instance.tags.iteritems():
+            key = self.to_safe("tag_" + k + "=" + v)
+            self.push(self.inventory, key, dest)
+            self.keep_first(self.inventory, 'first_in_' + key, dest)
+
+        # Inventory: Group by Route53 domain names if enabled
+        if self.route53_enabled:
+            route53_names = self.get_instance_route53_names(instance)
+            for name in route53_names:
+                self.push(self.inventory, name, dest)
+
+
+    def add_rds_instance(self, instance, region):
+        ''' Adds an RDS instance to the inventory and index, as long as it is
+        addressable '''
+
+        with self.profiler.section('grouping'):
+            self._add_rds_instance(instance, region)
+
+
+    def _add_rds_instance(self, instance, region):
+        # Only want available instances
+        if instance.status != 'available':
+            return
+
+        # Select the best destination address
+        #if instance.subnet_id:
+            #dest = getattr(instance, self.vpc_destination_variable)
+        #else:
+            #dest =  getattr(instance, self.destination_variable)
+        dest = instance.endpoint[0]
+
+        if not dest:
+            # Skip instances we cannot address (e.g. private VPC subnet)
+            return
+
+        # Add to index
+        self.index[dest] = [region, instance.id]
+
+        # Inventory: Group by instance ID (always a group of 1)
+        self.inventory[instance.id] = [dest]
+
+        # Inventory: Group by region
+        self.push(self.inventory, region, dest)
+
+        # Inventory: Group by availability zone
+        self.push(self.inventory, instance.availability_zone, dest)
+
+        # Inventory: Group by instance type
+        self.push(self.inventory, self.to_safe('type_' + instance.instance_class), dest)
+
+        # Inventory: Group by security group
+        try:
+            if instance.security_group:
+                key = self.to_safe("security_group_" + instance.security_group.name)
+                self.push(self.inventory, key, dest)
+        except AttributeError:
+            print 'Package boto seems a bit older.'
+            print 'Please upgrade boto >= 2.3.0.'
+            sys.exit(1)
+
+        # Inventory: Group by engine
+        self.push(self.inventory, self.to_safe("rds_" + instance.engine), dest)
+
+        # Inventory: Group by parameter group
+        self.push(self.inventory, self.to_safe("rds_parameter_group_" + instance.parameter_group.name), dest)
+
+
+    def get_route53_records(self):
+        ''' Get and store the map of resource records to domain names that
+        point to them. '''
+
+        if not self.refresh_cache and self.is_route53_cache_valid():
+            with self.profiler.section('cache io'):
+                cache = open(self.cache_path_route53, 'r')
+                self.route53_records = json.loads(cache.read())
+            return
+
+        with self.profiler.section('api fetch'):
+            r53_conn = self.connect('route53')
+            all_zones = r53_conn.get_zones()
+
+        route53_zones = [ zone for zone in all_zones if zone.name[:-1]
+                          not in self.route53_excluded_zones ]
+
+        zone_rrsets = self.run_concurrently(
+            [(zone.id, self.get_zone_rrsets, zone) for zone in route53_zones])
+
+        records = {}
+
+        for zone in route53_zones:
+            for record_set in zone_rrsets[zone.id]:
+                record_name = record_set.name
+
+                if record_name.endswith('.'):
+                    record_name = record_name[:-1]
+
+                values = list(record_set.resource_records)
+                if record_set.alias_dns_name:
+                    values.append(record_set.alias_dns_name.rstrip('.'))
+
+                for value in values:
+                    records.setdefault(value, set())
+                    records[value].add(record_name)
+
+        self.route53_records = dict(
+            (value, sorted(names)) for value, names in records.iteritems())
+        with self.profiler.section('cache io'):
+            with open(self.cache_path_route53, 'w') as cache:
+                cache.write(json.dumps(self.route53_records))
+
+
+    def get_zone_rrsets(self, zone):
+        ''' Makes the Route53 API calls to list every resource record set of
+        a zone, following the pagination markers '''
+
+        # Connections are not shared between the zone fetching threads
+        r53_conn = self.connect('route53')
+
+        record_sets = []
+        name = rrtype = identifier = None
+        while True:
+            with self.profiler.section('api fetch'):
+                page = r53_conn.get_all_rrsets(zone.id, name=name, type=rrtype,
+                                               identifier=identifier)
+
+            # Iterating the ResourceRecordSets itself would page through the
+            # rest of the zone, without the identifier of weighted records
+            record_sets.extend(list.__iter__(page))
+
+            if not page.is_truncated:
+                return record_sets
+
+            name = page.next_record_name
+            rrtype = page.next_record_type
+            identifier = getattr(page, 'NextRecordIdentifier', None)
+
+
+    def is_route53_cache_valid(self):
+        ''' Determines if the Route53 cache file has expired, it has its own
+        max age because zones change less often than instances '''
+
+        if os.path.isfile(self.cache_path_route53):
+            mod_time = os.path.getmtime(self.cache_path_route53)
+            if (mod_time + self.route53_cache_max_age) > time():
+                return True
+
+        return False
+
+
+    def get_instance_route53_names(self, instance):
+        ''' Check if an instance is referenced in the records we have from
+        Route53. If it is, return the list of domain names pointing to said
+        instance. If nothing points to it, return an empty list. '''
+
+        instance_attributes = [ 'public_dns_name', 'private_dns_name',
+                                'ip_address', 'private_ip_address' ]
+
+        name_list = set()
+
+        for attrib in instance_attributes:
+            try:
+                value = getattr(instance, attrib)
+            except AttributeError:
+                continue
+
+            if value in self.route53_records:
+                name_list.update(self.route53_records[value])
+
+        return list(name_list)
+
+
+    def get_host_info(self, host):
+        ''' Get variables about a specific host '''
+
+        if not self.refresh_cache:
+            host_vars = self.get_cached_host_vars(host)
+            if host_vars is not None:
+                return self.json_format_dict(host_vars, True)
+
+        location = self.get_index_entry(host)
+
+        if location is None:
+            # try updating the cache
+            self.do_api_calls_update_cache()
+            location = self.index.get(host)
+            if location is None:
+                # host migh not exist anymore
+                return self.json_format_dict({}, True)
+
+        (region, instance_id) = location
+
+        instance = self.get_instance(region, instance_id)
+        return self.json_format_dict(
+            self.get_host_info_dict_from_instance(instance), True)
+
+
+    def get_cached_host_vars(self, host):
+        ''' Returns the variables of a host captured during the last refresh,
+        or None if they are not in the cache '''
+
+        if len(self.hostvars) == 0:
+            try:
+                if self.cache_format == 'binary':
+                    return BinaryCache(self.cache_path_hostvars).get(host)
+
+                cache = open(self.cache_path_hostvars, 'r')
+                hostvars = json.loads(cache.read())
+            except (IOError, ValueError):
+                return None
+            # --tags-only used to write the list of its tag groups here
+            if not isinstance(hostvars, dict):
+                return None
+            self.hostvars = hostvars
+
+        return self.hostvars.get(host)
+
+
+    def get_host_info_dict_from_instance(self, instance):
+        ''' Builds the ec2_* variables of an instance '''
+
+        instance_vars = {}
+        for key in vars(instance):
+            value = getattr(instance, key)
+            key = self.to_safe('ec2_' + key)
+
+            # Handle complex types
+            if type(value) in [int, bool]:
+                instance_vars[key] = value
+            elif type(value) in [str, unicode]:
+                instance_vars[key] = value.strip()
+            elif type(value) == type(None):
+                instance_vars[key] = ''
+            elif key == 'ec2_region':
+                instance_vars[key] = value.name
+            elif key == 'ec2_tags':
+                for k, v in value.iteritems():
+                    key = self.to_safe('ec2_tag_' + k)
+                    instance_vars[key] = v
+            elif key == 'ec2_groups':
+                group_ids = []
+                group_names = []
+                for group in value:
+                    group_ids.append(group.id)
+                    group_names.append(group.name)
+                instance_vars["ec2_security_group_ids"] = ','.join(group_ids)
+                instance_vars["ec2_security_group_names"] = ','.join(group_names)
+            else:
+                pass
+                # TODO Product codes if someone finds them useful
+                #print key
+                #print type(value)
+                #print value
+
+        return instance_vars
+
+
+    def push(self, my_dict, key, element):
+        ''' Pushed an element onto an array that may not have been defined in
+        the dict '''
+
+        if isinstance(my_dict, InventoryGroups):
+            my_dict.push(key, element)
+        elif key in my_dict:
+            my_dict[key].append(element);
+        else:
+            my_dict[key] = [element]
+
+    def keep_first(self, my_dict, key, element):
+        if key not in my_dict:
+            my_dict[key] = [element]
+
+    def get_inventory_from_cache(self):
+        ''' Reads the inventory from the cache file and returns it as a JSON
+        object '''
+        if self.cache_format == 'binary' and not self.tags_only:
+            # Export the binary cache in the same JSON format as the json
+            # cache file
+            with self.profiler.section('cache io'):
+                inventory = dict(BinaryCache(self.cache_path_cache).iteritems())
+            with self.profiler.section('serialization'):
+                return self.json_format_dict(inventory, True)
+
+        with self.profiler.section('cache io'):
+            if self.tags_only:
+                cache = open(self.cache_path_tags, 'r')
+            else:
+                cache = open(self.cache_path_cache, 'r')
+            json_inventory = cache.read()
+        return json_inventory
+
+
+    def get_group_from_cache(self, group):
+        ''' Returns the hosts of a single group from the cache file '''
+
+        if self.cache_format == 'binary':
+            return BinaryCache(self.cache_path_cache).get(group, [])
+
+        cache = open(self.cache_path_cache, 'r')
+        return json.loads(cache.read()).get(group, [])
+
+
+    def get_index_entry(self, host):
+        ''' Returns the [region, instance ID] of a host, looking it up in
+        the cache files if the index has not been loaded '''
+
+        if len(self.index) == 0:
+            if self.cache_format == 'binary':
+                # Only read the one entry we need
+                try:
+                    return BinaryCache(self.cache_path_index).get(host)
+                except (IOError, ValueError):
+                    return None
+
+            # Need to load index from cache
+            self.load_index_from_cache()
+
+        return self.index.get(host)
+
+
+    def load_index_from_cache(self):
+        ''' Reads the index from the cache file sets self.index '''
+
+        with self.profiler.section('cache io'):
+            cache = open(self.cache_path_index, 'r')
+            json_index = cache.read()
+            index = json.loads(json_index)
+            # --tags-only used to write the list of its tag groups here
+            if isinstance(index, dict):
+                self.index = index
+
+
+    def load_segment(self, region):
+        ''' Reads the cache segment of a region, returns None if there is
+        no usable segment '''
+
+        try:
+            with open(self.cache_path_segment % region, 'r') as cache:
+                return json.loads(cache.read())
+        except (IOError, ValueError):
+            return None
+
+
+    def write_segment(self, region, segment):
+        ''' Writes the cache segment of a region '''
+
+        with open(self.cache_path_segment % region, 'w') as cache:
+            cache.write(json.dumps(segment))
+
+
+    def write_keyed_cache(self, data, filename):
+        ''' Writes the inventory or index in the configured cache format '''
+
+        if self.cache_format == 'binary':
+            with self.profiler.section('cache io'):
+                BinaryCache.write(data, filename)
+        elif self.streaming:
+            self.write_json_stream(JsonStreamWriter.sorted_items(data), filename)
+        else:
+            self.write_to_cache(data, filename)
+
+
+    def write_json_stream(self, items, filename):
+        ''' Writes sorted (key, value) pairs to a file as pretty-printed JSON,
+        one entry at a time '''
+
+        with self.profiler.section('cache io'):
+            with open(filename, 'w') as cache:
+                JsonStreamWriter(cache).write(items)
+
+
+    def write_to_cache(self, data, filename):
+        '''
+            Writes data in JSON format to a file
+            '''
+
+        with self.profiler.section('serialization'):
+            json_data = self.json_format_dict(data, True)
+        with self.profiler.section('cache io'):
+            cache = open(filename, 'w')
+            cache.write(json_data)
+            cache.close()
+
+
+    def to_safe(self, word):
+        ''' Converts 'bad' characters in a string to underscores so they can be
+        used as Ansible groups '''
+
+        # The same tag and security group names repeat across instances
+        safe = self.safe_words.get(word)
+        if safe is None:
+            if isinstance(word, unicode):
+                try:
+                    safe = unicode(word.encode('ascii').translate(SAFE_TABLE))
+                except UnicodeEncodeError:
+                    safe = UNSAFE_RE.sub("_", word)
+            else:
+                safe = word.translate(SAFE_TABLE)
+
+            if len(self.safe_words) >= SAFE_CACHE_SIZE:
+                self.safe_words.clear()
+            self.safe_words[word] = safe
+
+        return safe
+
+
+    def json_format_dict(self, data, pretty=False):
+        ''' Converts a dict to a JSON object and dumps it as a formatted
+        string '''
+        if pretty:
+            return json.dumps(data, sort_keys=True, indent=2)
+        else:
+            return json.dumps(data)
+
+
+class Inventory(object):
+    ''' The groups, index and host variables of an EC2 inventory '''
+
+    def __init__(self, groups, index, hostvars):
+        self.groups = groups
+        self.index = index
+        self.hostvars = hostvars
+
+
+    def get_host_vars(self, host):
+        ''' Returns the ec2_* variables of a host '''
+
+        return self.hostvars.get(host, {})
+
+
+    def to_dict(self):
+        ''' Returns the inventory in the format of the --list output '''
+
+        inventory = dict(self.groups)
+        inventory['_meta'] = {'hostvars': self.hostvars}
+        return inventory
+
+
+def build_inventory(config, refresh_cache=False, profiler=None):
+    ''' Returns the Inventory described by config, the path of an ec2.ini
+    file or a ConfigParser, using the cache files while they are valid '''
+
+    ec2_inventory = Ec2Inventory(config, refresh_cache=refresh_cache,
+                                 profiler=profiler)
+    ec2_inventory.update()
+    return ec2_inventory.get_inventory()
@@ -0,0 +1,91 @@
+'''
+Opt-in timing of the stages of an inventory run, enabled with --profile
+'''
+
+import threading
+from time import time
+
+
+class NullProfiler(object):
+    ''' Profiler used when --profile is not given, sections cost nothing '''
+
+    class NullSection(object):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+    SECTION = NullSection()
+
+    def section(self, name):
+        return self.SECTION
+
+    def report(self, stream):
+        pass
+
+
+class Profiler(object):
+    ''' Accumulates the time spent in named sections.
+
+    Sections can be nested, the time of an inner section is not counted in
+    the outer one. Sections entered from the fetch threads are added up, so
+    the totals can be larger than the wall clock time. '''
+
+    SECTIONS = ['api fetch', 'grouping', 'serialization', 'cache io']
+
+    def __init__(self):
+        self.start_time = time()
+        self.totals = dict((name, 0.0) for name in self.SECTIONS)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def section(self, name):
+        return ProfilerSection(self, name)
+
+    def add(self, name, elapsed):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.0) + elapsed
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def report(self, stream):
+        ''' Writes the time spent in each section to stream '''
+
+        stream.write("ec2 inventory profile (seconds):\n")
+        names = self.SECTIONS + sorted(set(self.totals) - set(self.SECTIONS))
+        for name in names:
+            stream.write("  {:<15}{:>9.3f}\n".format(name, self.totals[name]))
+        stream.write("  {:<15}{:>9.3f}\n".format('wall clock',
+                                                 time() - self.start_time))
+
+
+class ProfilerSection(object):
+    ''' Context manager timing one section, pausing the enclosing section
+    of the same thread while it runs '''
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        now = time()
+        stack = self.profiler.stack()
+        if stack:
+            parent = stack[-1]
+            self.profiler.add(parent.name, now - parent.started)
+        self.started = now
+        stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        now = time()
+        stack = self.profiler.stack()
+        stack.pop()
+        self.profiler.add(self.name, now - self.started)
+        if stack:
+            stack[-1].started = now
+        return False
@@ -0,0 +1,169 @@
+'''
+Recorded AWS API responses for running the inventory without AWS.
+
+With replay_fixtures set in ec2.ini, the EC2, RDS and Route53 connections
+of the inventory are replaced by connections that either record every
+response they get into that directory (replay_mode = record), or serve
+the recorded responses instead of calling AWS (replay_mode = replay).
+
+Responses are recorded as the raw bodies AWS sent, so replaying them goes
+through the same boto parsing as a live run. A request that was not
+recorded is answered with a 404 error naming the missing fixture.
+'''
+
+import os
+import hashlib
+
+from boto import ec2
+from boto import rds
+from boto.ec2.connection import EC2Connection
+from boto.rds import RDSConnection
+from boto.route53.connection import Route53Connection
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+MISSING_FIXTURE = '''<?xml version="1.0" encoding="UTF-8"?>
+<Response><Errors><Error><Code>MissingFixture</Code><Message>No recorded response for %s</Message></Error></Errors><RequestID>replay</RequestID></Response>'''
+
+
+class FixtureResponse(object):
+    ''' Stands in for the httplib response boto reads the body of '''
+
+    def __init__(self, status, reason, body, headers=None):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.headers = headers or {}
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def getheaders(self):
+        return self.headers.items()
+
+
+class FixtureStore(object):
+    ''' Directory of recorded responses, one file per distinct request.
+
+    Each file starts with a line of JSON describing the request and the
+    response status, followed by the response body as it was received. '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, request):
+        ''' Returns the name of the fixture of a request description '''
+
+        return hashlib.sha1(request).hexdigest() + '.fixture'
+
+    def load(self, request):
+        ''' Returns the recorded response to a request '''
+
+        filename = os.path.join(self.path, self.key(request))
+        if not os.path.isfile(filename):
+            return FixtureResponse(404, 'Not Found', MISSING_FIXTURE % request)
+
+        with open(filename, 'rb') as fixture:
+            header = json.loads(fixture.readline())
+            body = fixture.read()
+        return FixtureResponse(header['status'], header['reason'], body,
+                               header.get('headers'))
+
+    def save(self, request, response):
+        ''' Records a response and returns a copy of it that can still be
+        read '''
+
+        body = response.read()
+        headers = dict((name.lower(), value)
+                       for name, value in response.getheaders())
+        header = json.dumps({'request': json.loads(request),
+                             'status': response.status,
+                             'reason': response.reason,
+                             'headers': headers})
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        # Written aside and renamed, the fetch threads record concurrently
+        filename = os.path.join(self.path, self.key(request))
+        with open(filename + '.tmp', 'wb') as fixture:
+            fixture.write(header + '\n')
+            fixture.write(body)
+        os.rename(filename + '.tmp', filename)
+
+        return FixtureResponse(response.status, response.reason, body, headers)
+
+
+class FixtureConnection(object):
+    ''' Mixin for boto connections that records the responses of
+    make_request, or serves the recorded ones '''
+
+    fixtures = None
+    fixture_mode = 'replay'
+
+    # Called as upstream(connection, *args, **kwargs) instead of AWS when
+    # recording, used to record synthetic responses
+    fixture_upstream = None
+
+    def make_request(self, *args, **kwargs):
+        # Requests are told apart by everything passed to make_request
+        request = json.dumps([self.host, args, kwargs], sort_keys=True)
+
+        if self.fixture_mode == 'replay':
+            return self.fixtures.load(request)
+
+        # boto adds the signature to the params it is given, which must not
+        # end up in the next request made with the same params
+        args = [dict(arg) if isinstance(arg, dict) else arg for arg in args]
+        if self.fixture_upstream:
+            response = self.fixture_upstream(self, *args, **kwargs)
+        else:
+            response = super(FixtureConnection, self).make_request(*args, **kwargs)
+
+        return self.fixtures.save(request, response)
+
+
+class FixtureEC2Connection(FixtureConnection, EC2Connection):
+    pass
+
+
+class FixtureRDSConnection(FixtureConnection, RDSConnection):
+    pass
+
+
+class FixtureRoute53Connection(FixtureConnection, Route53Connection):
+    pass
+
+
+def connect(service, region, fixtures, mode='replay', upstream=None):
+    ''' Returns a recording or replaying connection to an AWS service,
+    which is one of ec2, rds or route53. Like boto's connect_to_region,
+    returns None if the region is not known '''
+
+    kwargs = {}
+    if mode == 'replay' or upstream:
+        # Keeps boto from looking for credentials it will never use
+        kwargs = {'aws_access_key_id': 'replay',
+                  'aws_secret_access_key': 'replay'}
+
+    if service == 'route53':
+        conn = FixtureRoute53Connection(**kwargs)
+    else:
+        module, cls = {'ec2': (ec2, FixtureEC2Connection),
+                       'rds': (rds, FixtureRDSConnection)}[service]
+        regions = [info for info in module.regions() if info.name == region]
+        if not regions:
+            return None
+        conn = cls(region=regions[0], **kwargs)
+
+    conn.fixtures = fixtures
+    conn.fixture_mode = mode
+    conn.fixture_upstream = upstream
+    return conn
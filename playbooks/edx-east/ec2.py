@@ -1 +0,0 @@
-../ec2.py
\ No newline at end of file
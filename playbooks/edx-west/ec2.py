@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+
+'''
+EC2 external inventory script for the edx-west playbooks, see ../ec2.py for the
+variables it provides. Reads ../ec2.ini unless ANSIBLE_EC2_INI is set.
+'''
+
+import os
+import sys
+
+playbooks_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, playbooks_dir)
+
+from ec2_inventory.cli import main
+
+
+if __name__ == '__main__':
+    main(playbooks_dir + '/ec2.ini')
@@ -1,47 +1,109 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-import time
+import os
+import sys
+import threading
 import boto
 
+# the waiter is shared with the scripts in util/vpc-tools
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', '..', 'util', 'vpc-tools'))
+from waiter import Waiter, WaiterTimeout
 
-def await_elb_instance_state(lb, instance_id, awaited_state):
-    """blocks until the ELB reports awaited_state
-    for instance_id.
-    lb = loadbalancer object
-    instance_id : instance_id (string)
+ELB_STATE_TIMEOUT = 600  # time to wait for an ELB to report a state
+
+
+def await_elb_instance_states(lbs, instance_ids, awaited_state):
+    """blocks until every ELB reports awaited_state
+    for every instance, or exits with a report of
+    the ones that did not get there in time.
+    lbs = loadbalancer objects
+    instance_ids : instance ids (list of strings)
     awaited_state : state to poll for (string)"""
 
-    start_time = time.time()
-    while True:
-        state = lb.get_instance_health([instance_id])[0].state
-        if state == awaited_state:
-            print "Load Balancer {lb} is in awaited state " \
-                  "{awaited_state}, proceeding.".format(
-                  lb=lb.dns_name,
-                  awaited_state=awaited_state)
-            break
-        else:
-            print "Checking again in 2 seconds. Elapsed time: {0}".format(
-                time.time() - start_time)
-            time.sleep(2)
+    # the ELBs are polled concurrently, boto connections
+    # can't be shared between threads
+    connections = dict((lb.name, boto.connect_elb()) for lb in lbs)
+    last_health = {}
+
+    def describe_lb(lb_name, ids, states, errors):
+        try:
+            for health in connections[lb_name].describe_instance_health(
+                    lb_name, ids):
+                key = "{}/{}".format(lb_name, health.instance_id)
+                states[key] = health.state
+                last_health[key] = health
+        except Exception as e:
+            errors.append(e)
+
+    def describe(keys):
+        pending = {}
+        for key in keys:
+            lb_name, instance_id = key.split('/', 1)
+            pending.setdefault(lb_name, []).append(instance_id)
+        states = {}
+        errors = []
+        threads = [threading.Thread(target=describe_lb,
+                                    args=(lb_name, ids, states, errors))
+                   for lb_name, ids in pending.iteritems()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            # the waiter retries throttling, anything else is fatal
+            raise errors[0]
+        return states
+
+    def progress(pending, elapsed):
+        print "Waiting on {0} instance(s) to be {1}. Elapsed time: " \
+              "{2:.0f}".format(len(pending), awaited_state, elapsed)
+
+    keys = ["{}/{}".format(lb.name, instance_id)
+            for lb in lbs for instance_id in instance_ids]
+    try:
+        Waiter(describe=describe,
+               ready=lambda state: state == awaited_state,
+               description="{} on {} ELB(s)".format(awaited_state, len(lbs)),
+               timeout=ELB_STATE_TIMEOUT, delay=2, max_delay=10,
+               progress=progress).wait(keys)
+    except WaiterTimeout:
+        print "Timed out after {0}s waiting for {1}:".format(
+            ELB_STATE_TIMEOUT, awaited_state)
+        for key in keys:
+            health = last_health.get(key)
+            if health is None:
+                print "    {0}: no health reported".format(key)
+            elif health.state != awaited_state:
+                print "    {0}: {1} ({2}) {3}".format(
+                    key, health.state, health.reason_code,
+                    health.description)
+        sys.exit(1)
+
+    for lb in lbs:
+        print "Load Balancer {lb} is in awaited state " \
+              "{awaited_state}, proceeding.".format(
+              lb=lb.dns_name,
+              awaited_state=awaited_state)
 
 
 def deregister():
-    """Deregister the instance from all ELBs and wait for the ELB
+    """Deregister the instances from all ELBs and wait for the ELBs
     to report them out-of-service"""
 
+    # the ELBs drain at the same time
     for lb in active_lbs:
-        lb.deregister_instances([args.instance])
-        await_elb_instance_state(lb, args.instance, 'OutOfService')
+        lb.deregister_instances(instances)
+    await_elb_instance_states(active_lbs, instances, 'OutOfService')
 
 
 def register():
-    """Register the instance for all ELBs and wait for the ELB
+    """Register the instances for all ELBs and wait for the ELBs
     to report them in-service"""
     for lb in active_lbs:
-        lb.register_instances([args.instance])
-        await_elb_instance_state(lb, args.instance, 'InService')
+        lb.register_instances(instances)
+    await_elb_instance_states(active_lbs, instances, 'InService')
 
 
 def parse_args():
@@ -52,8 +114,10 @@ def parse_args():
 
     parser.add_argument('-e', '--elbs', required=True,
                         help="Comma separated list of ELB names")
-    parser.add_argument('-i', '--instance', required=True,
-                        help="Single instance to operate on")
+    parser.add_argument('-i', '--instance', '--instances', required=True,
+                        dest='instance',
+                        help="Comma separated list of instances to "
+                             "operate on")
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -66,8 +130,13 @@ if __name__ == '__main__':
         for lb in elbs
         if lb.name in args.elbs.split(','))
 
+    instances = args.instance.split(',')
+    missing = set(args.elbs.split(',')) - set(lb.name for lb in active_lbs)
+    if missing:
+        print "ELB(s) not found: " + ", ".join(sorted(missing))
+
     print "ELB : " + str(args.elbs.split(','))
-    print "Instance: " + str(args.instance)
+    print "Instance: " + str(instances)
     if args.sp_action == 'deregister':
         print "Deregistering an instance"
         deregister()
@@ -11,7 +11,8 @@
 #            and we put the contents in a file that abby reads.
 #   - deployment - edx, edge, etc
 #   - environment - stage,prod, etc
-#   - play - forum, edxapp, xqueue, etc
+#   - play - forum, edxapp, xqueue, etc. Several comma separated plays
+#            are baked concurrently, e.g. edxapp,forum,xqueue
 #   - base_ami - Optional AMI to use as base AMI for abby instance
 #   - configuration - the version of the configuration repo to use
 #   - configuration_secure - the version of the secure repo to use
@@ -101,6 +102,11 @@ if [[ ! -z "$playbook_dir" ]]; then
   stackname_params="--playbook-dir $playbook_dir"
 fi
 
+play_params="-p $play"
+if [[ "$play" == *,* ]]; then
+  play_params="--plays $play"
+fi
+
 hipchat_params=""
 if [[ ! -z "$hipchat_room_id" ]] && [[ ! -z "$hipchat_api_token"  ]]; then
   hipchat_params="--hipchat-room-id $hipchat_room_id --hipchat-api-token $hipchat_api_token"
@@ -117,4 +123,4 @@ cat /var/tmp/$BUILD_ID-refs.yml
 echo "$vars" > /var/tmp/$BUILD_ID-extra-vars.yml
 cat /var/tmp/$BUILD_ID-extra-vars.yml
 
-python -u abbey.py -p $play -t c1.medium  -d $deployment -e $environment -i /edx/var/jenkins/.ssh/id_rsa $base_params $blessed_params $playbookdir_params --vars /var/tmp/$BUILD_ID-extra-vars.yml --refs /var/tmp/$BUILD_ID-refs.yml -c $BUILD_NUMBER --configuration-version $configuration --configuration-secure-version $configuration_secure -k $jenkins_admin_ec2_key --configuration-secure-repo $jenkins_admin_configuration_secure_repo $configurationprivate_params $hipchat_params
+python -u abbey.py $play_params -t c1.medium  -d $deployment -e $environment -i /edx/var/jenkins/.ssh/id_rsa $base_params $blessed_params $playbookdir_params --vars /var/tmp/$BUILD_ID-extra-vars.yml --refs /var/tmp/$BUILD_ID-refs.yml -c $BUILD_NUMBER --configuration-version $configuration --configuration-secure-version $configuration_secure -k $jenkins_admin_ec2_key --configuration-secure-repo $jenkins_admin_configuration_secure_repo $configurationprivate_params $hipchat_params
@@ -0,0 +1,257 @@
+#!/usr/bin/env python -u
+"""
+Aggregates the timing profiles abbey writes for every run
+(see --profile-dir) into a report of where bake time goes:
+
+  - the median and p95 of every stage
+  - the slowest tasks by median and p95
+  - the time spent in every role
+  - the tasks and stages of the latest run of each play that
+    regressed against the runs before it
+"""
+import os
+import sys
+import glob
+import json
+from argparse import ArgumentParser
+from collections import defaultdict
+
+PROFILE_DIR = '~/.abbey/profiles'  # where abbey keeps run profiles
+NUM_TASKS = 20  # number of tasks in the slowest tasks report
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('profiles', nargs='*',
+                        help="profile files or directories of them "
+                             "(defaults to {})".format(PROFILE_DIR),
+                        metavar="PROFILE")
+    parser.add_argument('-p', '--play', action='append',
+                        help="only report runs of this play, "
+                             "can be given more than once",
+                        metavar="PLAY")
+    parser.add_argument('-e', '--environment', metavar="ENVIRONMENT",
+                        help="only report runs of this environment")
+    parser.add_argument('-d', '--deployment', metavar="DEPLOYMENT",
+                        help="only report runs of this deployment")
+    parser.add_argument('--last', type=int, default=0, metavar="RUNS",
+                        help="only report the last RUNS runs of each play")
+    parser.add_argument('--include-failed', action='store_true',
+                        default=False,
+                        help="also report runs that did not produce an AMI")
+    parser.add_argument('-n', '--num-tasks', type=int, default=NUM_TASKS,
+                        help="number of slowest tasks to report")
+    parser.add_argument('--threshold', type=float, default=20,
+                        metavar="PERCENT",
+                        help="how much slower than the median of the "
+                             "previous runs a task has to be to be "
+                             "reported as a regression")
+    parser.add_argument('--min-delta', type=float, default=5,
+                        metavar="SECONDS",
+                        help="ignore regressions smaller than this")
+    parser.add_argument('--json', action='store_true', default=False,
+                        help="print the report as JSON")
+    return parser.parse_args()
+
+
+def load_profiles(paths):
+    """
+    Returns the profiles in the given files and
+    directories, oldest run first
+    """
+    filenames = []
+    for path in paths:
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            filenames.extend(glob.glob(os.path.join(path, '*.json')))
+        else:
+            filenames.append(path)
+
+    profiles = []
+    for filename in filenames:
+        try:
+            with open(filename) as f:
+                profiles.append(json.load(f))
+        except (IOError, ValueError) as e:
+            print >> sys.stderr, "Skipping profile {}: {}".format(filename, e)
+    return sorted(profiles, key=lambda profile: profile['start_time'])
+
+
+def select_profiles(profiles):
+    selected = []
+    for profile in profiles:
+        if args.play and profile['play'] not in args.play:
+            continue
+        if args.environment and profile['environment'] != args.environment:
+            continue
+        if args.deployment and profile['deployment'] != args.deployment:
+            continue
+        if profile['error'] and not args.include_failed:
+            continue
+        selected.append(profile)
+
+    if args.last:
+        by_play = defaultdict(list)
+        for profile in selected:
+            by_play[profile['play']].append(profile)
+        selected = sorted(
+            (profile for runs in by_play.values()
+             for profile in runs[-args.last:]),
+            key=lambda profile: profile['start_time'])
+    return selected
+
+
+def percentile(values, pct):
+    """
+    Returns the pct percentile of values, interpolating
+    between the two closest ones
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def task_times(profile):
+    """
+    Returns a dict of task name to the time the run spent
+    in it, role tasks are named "role | task". Tasks that
+    ran more than once in a run (e.g. a role included by
+    several plays) are added up.
+    """
+    times = defaultdict(float)
+    for task in profile['tasks']:
+        times[task['task'] or '-'] += task['delta']
+    return times
+
+
+def role_times(profile):
+    times = defaultdict(float)
+    for task in profile['tasks']:
+        times[task['role'] or '-'] += task['delta']
+    return times
+
+
+def stage_times(profile):
+    return dict((stage, delta) for stage, delta in profile['stages'])
+
+
+def distribution(samples):
+    """
+    Returns a list of (key, runs, median, p95, total)
+    for samples of key to the list of its times,
+    slowest median first
+    """
+    rows = []
+    for key, values in samples.iteritems():
+        rows.append((key, len(values), percentile(values, 50),
+                     percentile(values, 95), sum(values)))
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+def collect(profiles, times):
+    samples = defaultdict(list)
+    for profile in profiles:
+        for key, delta in times(profile).iteritems():
+            samples[key].append(delta)
+    return samples
+
+
+def regressions(profiles):
+    """
+    Compares the latest run of every play to the median
+    of its previous runs. Returns a list of
+    (play, kind, name, baseline, latest), worst first.
+    """
+    by_play = defaultdict(list)
+    for profile in profiles:
+        by_play[profile['play']].append(profile)
+
+    found = []
+    for play, runs in by_play.iteritems():
+        if len(runs) < 2:
+            continue
+        latest, previous = runs[-1], runs[:-1]
+        for kind, times in (('stage', stage_times), ('task', task_times)):
+            baseline = collect(previous, times)
+            for name, delta in times(latest).iteritems():
+                if name not in baseline:
+                    continue
+                median = percentile(baseline[name], 50)
+                if delta - median < args.min_delta:
+                    continue
+                if median and \
+                        (delta - median) * 100.0 / median < args.threshold:
+                    continue
+                found.append((play, kind, name, median, delta))
+    return sorted(found, key=lambda row: row[4] - row[3], reverse=True)
+
+
+def format_time(seconds):
+    if seconds is None:
+        return '-'
+    return "{:0>2.0f}:{:0>5.2f}".format(seconds // 60, seconds % 60)
+
+
+def print_distribution(title, rows, width=60):
+    print title
+    print
+    print "{:<{}} {:>5} {:>9} {:>9} {:>10}".format(
+        '', width, 'Runs', 'Median', 'p95', 'Total')
+    for key, runs, median, p95, total in rows:
+        print "{:<{}} {:>5} {:>9} {:>9} {:>10}".format(
+            key[:width], width, runs, format_time(median),
+            format_time(p95), format_time(total))
+    print
+
+
+def main():
+    profiles = select_profiles(
+        load_profiles(args.profiles or [PROFILE_DIR]))
+    if not profiles:
+        print "No profiles to report"
+        sys.exit(1)
+
+    stages = distribution(collect(profiles, stage_times))
+    tasks = distribution(collect(profiles, task_times))
+    roles = distribution(collect(profiles, role_times))
+    regressed = regressions(profiles)
+
+    if args.json:
+        json.dump({
+            'runs': len(profiles),
+            'plays': sorted(set(profile['play'] for profile in profiles)),
+            'stages': stages,
+            'tasks': tasks[:args.num_tasks],
+            'roles': roles,
+            'regressions': regressed,
+        }, sys.stdout, indent=1)
+        print
+        return
+
+    print "{} runs of {}".format(len(profiles), ', '.join(
+        sorted(set(profile['play'] for profile in profiles))))
+    print
+    print_distribution("Stages:", stages)
+    print_distribution("{} slowest tasks by median:".format(args.num_tasks),
+                       tasks[:args.num_tasks])
+    print_distribution("{} slowest tasks by p95:".format(args.num_tasks),
+                       sorted(tasks, key=lambda row: row[3],
+                              reverse=True)[:args.num_tasks])
+    print_distribution("Roles:", roles)
+
+    print "Regressions of the latest run of each play:"
+    print
+    if not regressed:
+        print "None"
+    for play, kind, name, median, latest in regressed:
+        print "{:<20} {:<5} {:<60} {:>9} -> {:>9}".format(
+            play, kind, name[:60], format_time(median), format_time(latest))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main()
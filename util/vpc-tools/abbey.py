@@ -5,6 +5,15 @@ import time
 import json
 import yaml
 import os
+import math
+import zlib
+import heapq
+import base64
+import hashlib
+import shutil
+import tempfile
+import threading
+import subprocess
 try:
     import boto.ec2
     import boto.sqs
@@ -16,12 +25,25 @@ except ImportError:
     sys.exit(1)
 
 from pprint import pprint
+from collections import defaultdict
+from waiter import Waiter, retry_throttled
 
 AMI_TIMEOUT = 600  # time to wait for AMIs to complete
 EC2_RUN_TIMEOUT = 180  # time to wait for ec2 state transition
 EC2_STATUS_TIMEOUT = 300  # time to wait for ec2 system status checks
 NUM_TASKS = 5  # number of tasks for time summary report
 NUM_PLAYBOOKS = 2
+EC2_MAX_TAGS_PER_REQUEST = 50  # tags create_tags accepts per call
+TOOLCHAIN_TIMEOUT = 1800  # time to wait for a toolchain builder to stop
+SQS_WAIT_TIME = 20  # longest wait allowed when long polling sqs
+PROFILE_DIR = '~/.abbey/profiles'  # where run profiles are kept
+
+# packages installed before configuration can be cloned and
+# its requirements installed
+TOOLCHAIN_APT_PACKAGES = [
+    'git', 'python-pip', 'python-apt', 'git-core', 'build-essential',
+    'python-dev', 'libxml2-dev', 'libxslt-dev', 'curl',
+]
 
 
 class Unbuffered:
@@ -56,9 +78,28 @@ def parse_args():
                         help="defaults to ENVIRONMENT-DEPLOYMENT",
                         metavar="STACK_NAME",
                         required=False)
-    parser.add_argument('-p', '--play',
+    plays = parser.add_mutually_exclusive_group(required=True)
+    plays.add_argument('-p', '--play',
                         help='play name without the yml extension',
-                        metavar="PLAY", required=True)
+                        metavar="PLAY")
+    plays.add_argument('--plays',
+                        help="comma separated plays to bake concurrently, "
+                             "one abbey run per play",
+                        metavar="PLAYS")
+    plays.add_argument('--build-matrix',
+                        help="YAML list of plays to bake concurrently, "
+                             "either play names or mappings with a 'play' "
+                             "and abbey options to override for it",
+                        metavar="BUILD_MATRIX_FILE")
+    parser.add_argument('--summary-file', required=False,
+                        help="write the outcome of the run to this file "
+                             "as JSON",
+                        metavar="SUMMARY_FILE")
+    parser.add_argument('--build-index', type=int, required=False,
+                        help="index of the build matrix entry this run "
+                             "bakes, added to the run id so runs of the "
+                             "same play started together do not collide",
+                        metavar="INDEX")
     parser.add_argument('--playbook-dir',
                         help='directory to find playbooks in',
                         default='configuration/playbooks/edx-east',
@@ -109,9 +150,9 @@ def parse_args():
                         default="abbey",
                         help="IAM role name to use (must exist)")
     parser.add_argument("--msg-delay", required=False,
-                        default=5,
-                        help="How long to delay message display from sqs "
-                             "to ensure ordering")
+                        default=5, type=float,
+                        help="How long to wait for a missing message "
+                             "from sqs before displaying the ones after it")
     parser.add_argument("--hipchat-room-id", required=False,
                         default=None,
                         help="The API ID of the Hipchat room to post"
@@ -120,6 +161,29 @@ def parse_args():
                         default=None,
                         help="The API token for Hipchat integration")
 
+    parser.add_argument("--profile-dir", required=False,
+                        default=PROFILE_DIR,
+                        help="directory to write the timing profile of "
+                             "the run to, for abbey-report.py "
+                             "(defaults to {})".format(PROFILE_DIR),
+                        metavar="PROFILE_DIR")
+    parser.add_argument("--no-profile", action='store_true',
+                        default=False,
+                        help="don't write a timing profile of the run")
+    parser.add_argument("--toolchain", action='store_true',
+                        default=False,
+                        help="start from a toolchain AMI that has the "
+                             "packages and requirements of this "
+                             "configuration version installed, baking it "
+                             "first if there is none")
+    parser.add_argument("--warm-pool", type=int, default=0,
+                        metavar="SIZE",
+                        help="keep up to SIZE stopped builders to start "
+                             "instead of launching new instances")
+    parser.add_argument("--tag-snapshots", action='store_true',
+                        default=False,
+                        help="also tag the snapshots backing the AMI")
+
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-b', '--base-ami', required=False,
                         help="ami to use as a base ami",
@@ -241,9 +305,7 @@ export ANSIBLE_ENABLE_SQS SQS_NAME SQS_REGION SQS_MSG_PREFIX PYTHONUNBUFFERED
 if [[ ! -x /usr/bin/git || ! -x /usr/bin/pip ]]; then
     echo "Installing pkg dependencies"
     /usr/bin/apt-get update
-    /usr/bin/apt-get install -y git python-pip python-apt \\
-        git-core build-essential python-dev libxml2-dev \\
-        libxslt-dev curl --force-yes
+    /usr/bin/apt-get install -y {apt_packages} --force-yes
 fi
 
 
@@ -335,7 +397,8 @@ rm -rf $base_dir
                 extra_vars_yml=extra_vars_yml,
                 git_refs_yml=git_refs_yml,
                 secure_vars=secure_vars,
-                cache_id=args.cache_id)
+                cache_id=args.cache_id,
+                apt_packages=' '.join(TOOLCHAIN_APT_PACKAGES))
 
     ec2_args = {
         'security_group_ids': [security_group_id],
@@ -351,6 +414,341 @@ rm -rf $base_dir
     return ec2_args
 
 
+def toolchain_key(base_ami):
+    """
+    Returns the hash identifying the toolchain AMI built
+    from base_ami for this configuration version
+    """
+    requirements = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        '..', '..', 'requirements.txt')
+    digest = hashlib.sha1()
+    digest.update(base_ami + '\n')
+    digest.update(args.configuration_version + '\n')
+    digest.update(' '.join(TOOLCHAIN_APT_PACKAGES) + '\n')
+    with open(requirements) as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_toolchain_ami(ec2_args):
+    """
+    Returns the toolchain AMI for the base AMI in ec2_args,
+    baking it first if there is none with a matching
+    toolchain_key tag
+    """
+    key = toolchain_key(ec2_args['image_id'])
+    images = ec2.get_all_images(
+        owners=['self'],
+        filters={'tag:toolchain_key': key, 'state': 'available'})
+    if images:
+        print "{:<40}{}".format("Using toolchain AMI:", images[0].id)
+        return images[0].id
+
+    print "{:<40}".format("Baking toolchain AMI {}:".format(key[:12])),
+    user_data = """#!/bin/bash
+set -x
+set -e
+exec > >(tee /var/log/user-data.log|logger -t user-data -s 2>/dev/console) 2>&1
+base_dir="/var/tmp/edx-toolchain"
+
+/usr/bin/apt-get update
+/usr/bin/apt-get install -y {apt_packages} --force-yes
+
+rm -rf $base_dir
+mkdir -p $base_dir
+cd $base_dir
+git clone https://github.com/edx/configuration
+cd configuration
+git checkout {configuration_version}
+sudo pip install -r requirements.txt
+cd /
+rm -rf $base_dir
+
+# the toolchain AMI is created once the builder has stopped
+shutdown -h now
+""".format(apt_packages=' '.join(TOOLCHAIN_APT_PACKAGES),
+           configuration_version=args.configuration_version)
+
+    toolchain_start = time.time()
+    res = ec2.run_instances(**dict(ec2_args, user_data=user_data))
+    builder_id = res.instances[0].id
+    try:
+        Waiter(describe=describe_instance_states,
+               ready=lambda state: state == 'stopped',
+               failed=lambda state: state in ('shutting-down', 'terminated'),
+               description="toolchain builder to stop",
+               timeout=TOOLCHAIN_TIMEOUT, delay=10, max_delay=30,
+               retry_codes=['InvalidInstanceID.NotFound']).wait([builder_id])
+        image_id = ec2.create_image(
+            builder_id, 'abbey-toolchain-{}'.format(key),
+            'abbey toolchain for configuration {}'.format(
+                args.configuration_version))
+        wait_for_image(image_id)
+        tag_resources([image_id], {
+            'toolchain_key': key,
+            'configuration_ref': args.configuration_version,
+        })
+    finally:
+        ec2.terminate_instances(instance_ids=[builder_id])
+
+    toolchain_delta = time.time() - toolchain_start
+    run_summary.append(('Toolchain AMI', toolchain_delta))
+    print "[ OK ] {:0>2.0f}:{:0>2.0f} {}".format(
+        toolchain_delta / 60,
+        toolchain_delta % 60,
+        image_id)
+    return image_id
+
+
+# User data of the builders waiting in the warm pool. It
+# stops them once booted and has the next boot run the user
+# data they are started with, cloud-init only runs user data
+# on the first boot. The rc.local hook puts the original
+# rc.local back before running it, so it is gone by the time
+# the builder is imaged.
+POOL_USER_DATA = """#!/bin/bash
+if [ -e /etc/rc.local ]; then
+    mv /etc/rc.local /etc/rc.local.abbey-pool
+fi
+cat << 'EOF' > /etc/rc.local
+#!/bin/bash
+rm -f /etc/rc.local
+if [ -e /etc/rc.local.abbey-pool ]; then
+    mv /etc/rc.local.abbey-pool /etc/rc.local
+fi
+curl -s http://169.254.169.254/latest/user-data > /var/tmp/user-data.sh
+chmod 700 /var/tmp/user-data.sh
+nohup /var/tmp/user-data.sh > /dev/null 2>&1 &
+if [ -x /etc/rc.local ]; then
+    exec /etc/rc.local
+fi
+exit 0
+EOF
+chmod 755 /etc/rc.local
+shutdown -h now
+"""
+
+
+def pool_key(ec2_args):
+    """
+    Returns the hash of everything but the user data a
+    builder is launched with, pooled builders can only be
+    used by runs with the same key
+    """
+    launch_args = dict(ec2_args)
+    del launch_args['user_data']
+    return hashlib.sha1(json.dumps(launch_args, sort_keys=True)).hexdigest()
+
+
+def claim_builder(instance_id, user_data):
+    """
+    Starts a pooled builder with user_data, returns whether
+    it booted with it. Runs sharing the pool may start the
+    same builder, the user data of a stopped instance can be
+    replaced until it starts, so the run whose user data the
+    running builder has gets it and the others move on.
+    """
+    try:
+        ec2.modify_instance_attribute(
+            instance_id, 'userData', base64.b64encode(user_data))
+        ec2.start_instances(instance_ids=[instance_id])
+    except EC2ResponseError as e:
+        # started or claimed by another run in the meantime
+        if e.error_code != 'IncorrectInstanceState':
+            raise
+        return False
+    Waiter(describe=describe_instance_states,
+           ready=lambda state: state == 'running',
+           failed=lambda state: state in ('shutting-down', 'terminated'),
+           description="running status", timeout=EC2_RUN_TIMEOUT,
+           max_delay=5).wait([instance_id])
+    attribute = ec2.get_instance_attribute(instance_id, 'userData')
+    return base64.b64decode(attribute.get('userData') or '') == user_data
+
+
+def start_builder(ec2_args):
+    """
+    Starts a stopped builder from the warm pool with the
+    user data of this run, or launches a new instance if
+    there is none. Returns the instance id.
+    """
+    if args.warm_pool:
+        reservations = ec2.get_all_instances(filters={
+            'tag:abbey_pool': pool_key(ec2_args),
+            'instance-state-name': 'stopped'})
+        for reservation in reservations:
+            for instance in reservation.instances:
+                if not claim_builder(instance.id, ec2_args['user_data']):
+                    continue
+                ec2.create_tags([instance.id], {'abbey_pool': run_id})
+                print "{:<40}{}".format("Starting pooled builder:",
+                                        instance.id)
+                return instance.id
+
+    res = ec2.run_instances(**ec2_args)
+    return res.instances[0].id
+
+
+def fill_pool(ec2_args):
+    """
+    Launches builders into the warm pool until it holds
+    --warm-pool of them, they stop on their own once booted
+    """
+    key = pool_key(ec2_args)
+    reservations = ec2.get_all_instances(filters={
+        'tag:abbey_pool': key,
+        'instance-state-name': ['pending', 'running', 'stopping', 'stopped']})
+    missing = args.warm_pool - sum(
+        len(reservation.instances) for reservation in reservations)
+    if missing <= 0:
+        return
+
+    print "{:<40}{}".format("Adding builders to the warm pool:", missing)
+    pool_args = dict(ec2_args, user_data=POOL_USER_DATA,
+                     min_count=missing, max_count=missing)
+    res = ec2.run_instances(**pool_args)
+    instance_ids = [instance.id for instance in res.instances]
+    retry_throttled(
+        lambda: ec2.create_tags(instance_ids, {'abbey_pool': key}),
+        retry_codes=['InvalidInstanceID.NotFound'])
+
+
+def describe_instance_states(instance_ids):
+    return dict(
+        (instance.id, instance.state)
+        for reservation in ec2.get_all_instances(instance_ids=instance_ids)
+        for instance in reservation.instances)
+
+
+class PayloadDecoder(object):
+    """
+    Decodes the message bodies sent by the sqs callback
+    plugin, see PayloadEncoder in
+    playbooks/callback_plugins/sqs.py.
+
+    Parts of chunked events are held until the last one
+    arrives.
+    """
+    def __init__(self):
+        self.chunks = {}
+
+    def decode(self, body):
+        """
+        Returns the event of a message body, or None if it
+        is part of an event that is not complete yet.
+        Raises ValueError for bodies that cannot be decoded.
+        """
+        msg = json.loads(body)
+        if 'ENCODING' not in msg:
+            return msg
+
+        if 'CHUNK' in msg:
+            chunk = msg['CHUNK']
+            parts = self.chunks.setdefault(chunk['ID'], {})
+            parts[chunk['PART']] = msg['DATA']
+            if len(parts) < chunk['PARTS']:
+                return None
+            del self.chunks[chunk['ID']]
+            data = ''.join(parts[part] for part in range(chunk['PARTS']))
+        else:
+            data = msg['DATA']
+
+        try:
+            data = base64.b64decode(data)
+            if msg['ENCODING'] == 'zlib+base64':
+                data = zlib.decompress(data)
+        except (TypeError, zlib.error) as e:
+            raise ValueError("unable to decode {} data: {}".format(
+                msg['ENCODING'], e))
+        return json.loads(data)
+
+
+class EventBuffer(object):
+    """
+    Puts the events read off of SQS back in order, since SQS
+    does not guarantee FIFO.
+
+    Events from the sqs callback plugin carry the RUN they
+    belong to and their SEQ number within it. They are
+    released in RUN and SEQ order as soon as the event before
+    them has been released. If an event is missing for more
+    than max_delay seconds the events after it are released
+    anyway, and the missing event is released as late
+    whenever it arrives. Duplicate deliveries are dropped.
+
+    Events without a SEQ are released in TS order once they
+    have been buffered for max_delay seconds.
+    """
+    def __init__(self, max_delay):
+        self.max_delay = max_delay
+        self.sequenced = []
+        self.unsequenced = []
+        self.next_seq = {}
+        # SEQs passed over by next_seq that were never released
+        self.skipped = {}
+
+    def __len__(self):
+        return len(self.sequenced) + len(self.unsequenced)
+
+    def push(self, msg_info):
+        msg = msg_info['msg']
+        if 'SEQ' in msg:
+            if msg['SEQ'] < self.next_seq.get(msg['RUN'], 0) and \
+                    msg['SEQ'] not in self.skipped.get(msg['RUN'], ()):
+                return
+            heapq.heappush(self.sequenced,
+                           (msg['RUN'], msg['SEQ'], msg_info))
+        else:
+            heapq.heappush(self.unsequenced, (msg['TS'], msg_info))
+
+    def pop_ready(self, now):
+        """
+        Returns the list of events that can be displayed
+        """
+        ready = []
+        while self.sequenced:
+            run, seq, msg_info = self.sequenced[0]
+            expected = self.next_seq.get(run, 0)
+            if seq > expected and \
+                    now - msg_info['recv_ts'] <= self.max_delay:
+                # wait for the events before this one
+                break
+            heapq.heappop(self.sequenced)
+            if seq >= expected:
+                if seq > expected:
+                    self.skipped.setdefault(run, set()).update(
+                        range(expected, seq))
+                self.next_seq[run] = seq + 1
+                ready.append(msg_info)
+            elif seq in self.skipped.get(run, ()):
+                self.skipped[run].discard(seq)
+                msg_info['late'] = True
+                ready.append(msg_info)
+
+        # the sqs timestamp is not as accurate as TS, it is only
+        # used to know how long an event has been waiting
+        while self.unsequenced:
+            ts, msg_info = self.unsequenced[0]
+            if now - msg_info['recv_ts'] <= self.max_delay:
+                break
+            heapq.heappop(self.unsequenced)
+            ready.append(msg_info)
+
+        return ready
+
+    def wait_time(self, now):
+        """
+        Returns the seconds until a waiting event has to be
+        released, or None if nothing is waiting
+        """
+        waiting = [msg_info['recv_ts'] for _, _, msg_info in self.sequenced]
+        waiting.extend(msg_info['recv_ts'] for _, msg_info in self.unsequenced)
+        if not waiting:
+            return None
+        return max(0, min(waiting) + self.max_delay - now)
+
+
 def poll_sqs_ansible():
     """
     Prints events to the console and
@@ -358,114 +756,129 @@ def poll_sqs_ansible():
     event is read off of SQS.
 
     SQS does not guarantee FIFO, for that
-    reason there is a buffer that will delay
-    messages before they are printed to the
-    console.
+    reason events go through a buffer that
+    puts them back in order before they are
+    printed to the console.
 
-    Returns length of the ansible run.
+    Returns length of the ansible run, the
+    results of every task and the SUMMARY
+    event of every playbook.
     """
-    oldest_msg_ts = 0
-    buf = []
+    buf = EventBuffer(args.msg_delay)
     task_report = []  # list of tasks for reporting
+    summaries = []
     last_task = None
+    last_handler = False
     completed = 0
+    decoder = PayloadDecoder()
     while True:
-        messages = []
-        while True:
-            # get all available messages on the queue
-            msgs = sqs_queue.get_messages(attributes='All')
-            if not msgs:
-                break
-            messages.extend(msgs)
+        # long poll for up to 10 messages, returning early if
+        # a buffered event has to be released
+        wait_time = buf.wait_time(time.time())
+        if wait_time is None:
+            wait_time = SQS_WAIT_TIME
+        messages = sqs_queue.get_messages(
+            num_messages=10, attributes='All',
+            wait_time_seconds=int(math.ceil(min(SQS_WAIT_TIME, wait_time))))
 
         for message in messages:
             recv_ts = float(
                 message.attributes['ApproximateFirstReceiveTimestamp']) * .001
             sent_ts = float(message.attributes['SentTimestamp']) * .001
             try:
-                msg_info = {
-                    'msg': json.loads(message.get_body()),
-                    'sent_ts': sent_ts,
-                    'recv_ts': recv_ts,
-                }
-                buf.append(msg_info)
+                msg = decoder.decode(message.get_body())
+                if msg is not None:
+                    msg_info = {
+                        'msg': msg,
+                        'sent_ts': sent_ts,
+                        'recv_ts': recv_ts,
+                    }
+                    buf.push(msg_info)
             except ValueError as e:
                 print "!!! ERROR !!! unable to parse queue message, " \
                       "expecting valid json: {} : {}".format(
                           message.get_body(), e)
-            if not oldest_msg_ts or recv_ts < oldest_msg_ts:
-                oldest_msg_ts = recv_ts
-            sqs_queue.delete_message(message)
+        if messages:
+            sqs_queue.delete_message_batch(messages)
 
-        now = int(time.time())
-        if buf:
+        for to_disp in buf.pop_ready(time.time()):
             try:
-                if (now - max([msg['recv_ts'] for msg in buf])) > args.msg_delay:
-                    # sort by TS instead of recv_ts
-                    # because the sqs timestamp is not as
-                    # accurate
-                    buf.sort(key=lambda k: k['msg']['TS'])
-                    to_disp = buf.pop(0)
-                    if 'START' in to_disp['msg']:
-                        print '\n{:0>2.0f}:{:0>5.2f} {} : Starting "{}"'.format(
-                            to_disp['msg']['TS'] / 60,
-                            to_disp['msg']['TS'] % 60,
-                            to_disp['msg']['PREFIX'],
-                            to_disp['msg']['START']),
-
-                    elif 'TASK' in to_disp['msg']:
-                        print "\n{:0>2.0f}:{:0>5.2f} {} : {}".format(
-                            to_disp['msg']['TS'] / 60,
-                            to_disp['msg']['TS'] % 60,
-                            to_disp['msg']['PREFIX'],
-                            to_disp['msg']['TASK']),
+                if to_disp.get('late'):
+                    print "\n{:0>2.0f}:{:0>5.2f} {} : (late)".format(
+                        to_disp['msg']['TS'] / 60,
+                        to_disp['msg']['TS'] % 60,
+                        to_disp['msg']['PREFIX']),
+
+                if 'START' in to_disp['msg']:
+                    print '\n{:0>2.0f}:{:0>5.2f} {} : Starting "{}"'.format(
+                        to_disp['msg']['TS'] / 60,
+                        to_disp['msg']['TS'] % 60,
+                        to_disp['msg']['PREFIX'],
+                        to_disp['msg']['START']),
+
+                elif 'TASK' in to_disp['msg']:
+                    handler = to_disp['msg'].get('HANDLER', False)
+                    print "\n{:0>2.0f}:{:0>5.2f} {} : {}{}".format(
+                        to_disp['msg']['TS'] / 60,
+                        to_disp['msg']['TS'] % 60,
+                        to_disp['msg']['PREFIX'],
+                        "HANDLER " if handler else "",
+                        to_disp['msg']['TASK']),
+                    # the events after a late task belong to a later one
+                    if not to_disp.get('late'):
                         last_task = to_disp['msg']['TASK']
-                    elif 'OK' in to_disp['msg']:
-                        if args.verbose:
-                            print "\n"
-                            for key, value in to_disp['msg']['OK'].iteritems():
-                                print "    {:<15}{}".format(key, value)
-                        else:
-                            invocation = to_disp['msg']['OK']['invocation']
-                            module = invocation['module_name']
-                            # 'set_fact' does not provide a changed value.
-                            if module == 'set_fact':
-                                changed = "OK"
-                            elif to_disp['msg']['OK']['changed']:
-                                changed = "*OK*"
-                            else:
-                                changed = "OK"
-                            print " {}".format(changed),
-                        task_report.append({
-                            'TASK': last_task,
-                            'INVOCATION': to_disp['msg']['OK']['invocation'],
-                            'DELTA': to_disp['msg']['delta'],
-                        })
-                    elif 'FAILURE' in to_disp['msg']:
-                        print " !!!! FAILURE !!!!",
-                        for key, value in to_disp['msg']['FAILURE'].iteritems():
+                        last_handler = handler
+                elif 'OK' in to_disp['msg']:
+                    if args.verbose:
+                        print "\n"
+                        for key, value in to_disp['msg']['OK'].iteritems():
                             print "    {:<15}{}".format(key, value)
-                        raise Exception("Failed Ansible run")
-                    elif 'STATS' in to_disp['msg']:
-                        print "\n{:0>2.0f}:{:0>5.2f} {} : COMPLETE".format(
-                            to_disp['msg']['TS'] / 60,
-                            to_disp['msg']['TS'] % 60,
-                            to_disp['msg']['PREFIX'])
-
-                        # Since 3 ansible plays get run.
-                        # We see the COMPLETE message 3 times
-                        # wait till the last one to end listening
-                        # for new messages.
-                        completed += 1
-                        if completed >= NUM_PLAYBOOKS:
-                            return (to_disp['msg']['TS'], task_report)
+                    else:
+                        invocation = to_disp['msg']['OK']['invocation']
+                        module = invocation['module_name']
+                        # 'set_fact' does not provide a changed value.
+                        if module == 'set_fact':
+                            changed = "OK"
+                        elif to_disp['msg']['OK']['changed']:
+                            changed = "*OK*"
+                        else:
+                            changed = "OK"
+                        print " {}".format(changed),
+                    invocation = to_disp['msg']['OK']['invocation']
+                    task_report.append({
+                        'TASK': last_task,
+                        'INVOCATION': invocation,
+                        'MODULE': invocation['module_name'],
+                        'PREFIX': to_disp['msg']['PREFIX'],
+                        'HOST': to_disp['msg'].get('HOST'),
+                        'ITEM': to_disp['msg'].get('item'),
+                        'HANDLER': last_handler,
+                        'DELTA': to_disp['msg']['delta'],
+                    })
+                elif 'FAILURE' in to_disp['msg']:
+                    print " !!!! FAILURE !!!!",
+                    for key, value in to_disp['msg']['FAILURE'].iteritems():
+                        print "    {:<15}{}".format(key, value)
+                    raise Exception("Failed Ansible run")
+                elif 'SUMMARY' in to_disp['msg']:
+                    summaries.append(to_disp['msg']['SUMMARY'])
+                elif 'STATS' in to_disp['msg']:
+                    print "\n{:0>2.0f}:{:0>5.2f} {} : COMPLETE".format(
+                        to_disp['msg']['TS'] / 60,
+                        to_disp['msg']['TS'] % 60,
+                        to_disp['msg']['PREFIX'])
+
+                    # Since 3 ansible plays get run.
+                    # We see the COMPLETE message 3 times
+                    # wait till the last one to end listening
+                    # for new messages.
+                    completed += 1
+                    if completed >= NUM_PLAYBOOKS:
+                        return (to_disp['msg']['TS'], task_report,
+                                summaries)
             except KeyError:
                 print "Failed to print status from message: {}".format(to_disp)
 
-        if not messages:
-            # wait 1 second between sqs polls
-            time.sleep(1)
-
 
 def create_ami(instance_id, name, description):
 
@@ -474,47 +887,57 @@ def create_ami(instance_id, name, description):
               'description': description,
               'no_reboot': True}
 
-    AWS_API_WAIT_TIME = 1
     image_id = ec2.create_image(**params)
     print("Checking if image is ready.")
-    for _ in xrange(AMI_TIMEOUT):
-        try:
-            img = ec2.get_image(image_id)
-            if img.state == 'available':
-                print("Tagging image.")
-                img.add_tag("environment", args.environment)
-                time.sleep(AWS_API_WAIT_TIME)
-                img.add_tag("deployment", args.deployment)
-                time.sleep(AWS_API_WAIT_TIME)
-                img.add_tag("play", args.play)
-                time.sleep(AWS_API_WAIT_TIME)
-                img.add_tag("configuration_ref", args.configuration_version)
-                time.sleep(AWS_API_WAIT_TIME)
-                img.add_tag("configuration_secure_ref", args.configuration_secure_version)
-                time.sleep(AWS_API_WAIT_TIME)
-                img.add_tag("configuration_secure_repo", args.configuration_secure_repo)
-                time.sleep(AWS_API_WAIT_TIME)
-                img.add_tag("cache_id", args.cache_id)
-                time.sleep(AWS_API_WAIT_TIME)
-                for repo, ref in git_refs.items():
-                    key = "refs:{}".format(repo)
-                    img.add_tag(key, ref)
-                    time.sleep(AWS_API_WAIT_TIME)
-                break
-            else:
-                time.sleep(1)
-        except EC2ResponseError as e:
-            if e.error_code == 'InvalidAMIID.NotFound':
-                time.sleep(1)
-            else:
-                raise Exception("Unexpected error code: {}".format(
-                    e.error_code))
-            time.sleep(1)
-    else:
-        raise Exception("Timeout waiting for AMI to finish")
+    wait_for_image(image_id)
+
+    tags = {
+        "environment": args.environment,
+        "deployment": args.deployment,
+        "play": args.play,
+        "configuration_ref": args.configuration_version,
+        "configuration_secure_ref": args.configuration_secure_version,
+        "configuration_secure_repo": args.configuration_secure_repo,
+        "cache_id": args.cache_id,
+    }
+    for repo, ref in git_refs.items():
+        tags["refs:{}".format(repo)] = ref
+
+    resource_ids = [image_id]
+    if args.tag_snapshots:
+        img = ec2.get_image(image_id)
+        resource_ids.extend(
+            device.snapshot_id
+            for device in img.block_device_mapping.values()
+            if device.snapshot_id)
+
+    print("Tagging image.")
+    tag_resources(resource_ids, tags)
 
     return image_id
 
+
+def wait_for_image(image_id):
+    Waiter(describe=lambda ids: dict(
+               (img.id, img.state) for img in
+               ec2.get_all_images(image_ids=ids)),
+           ready=lambda state: state == 'available',
+           failed=lambda state: state == 'failed',
+           description="AMI to finish", timeout=AMI_TIMEOUT,
+           delay=5, max_delay=30,
+           retry_codes=['InvalidAMIID.NotFound']).wait([image_id])
+
+
+def tag_resources(resource_ids, tags):
+    """
+    Adds tags to resources with one create_tags call
+    per EC2_MAX_TAGS_PER_REQUEST tags
+    """
+    items = sorted(tags.items())
+    for start in xrange(0, len(items), EC2_MAX_TAGS_PER_REQUEST):
+        chunk = dict(items[start:start + EC2_MAX_TAGS_PER_REQUEST])
+        retry_throttled(lambda: ec2.create_tags(resource_ids, chunk))
+
 def launch_and_configure(ec2_args):
     """
     Creates an sqs queue, launches an ec2 instance,
@@ -522,6 +945,9 @@ def launch_and_configure(ec2_args):
     SQS for updates
     """
 
+    if args.toolchain:
+        ec2_args['image_id'] = get_toolchain_ami(ec2_args)
+
     print "{:<40}".format(
         "Creating SQS queue and launching instance for {}:".format(run_id))
     print
@@ -534,50 +960,46 @@ def launch_and_configure(ec2_args):
     global instance_id
     sqs_queue = sqs.create_queue(run_id)
     sqs_queue.set_message_class(RawMessage)
-    res = ec2.run_instances(**ec2_args)
-    inst = res.instances[0]
-    instance_id = inst.id
+    instance_id = start_builder(ec2_args)
+    if args.warm_pool:
+        fill_pool(ec2_args)
 
     print "{:<40}".format(
         "Waiting for instance {} to reach running status:".format(instance_id)),
     status_start = time.time()
-    for _ in xrange(EC2_RUN_TIMEOUT):
-        res = ec2.get_all_instances(instance_ids=[instance_id])
-        if res[0].instances[0].state == 'running':
-            status_delta = time.time() - status_start
-            run_summary.append(('EC2 Launch', status_delta))
-            print "[ OK ] {:0>2.0f}:{:0>2.0f}".format(
-                status_delta / 60,
-                status_delta % 60)
-            break
-        else:
-            time.sleep(1)
-    else:
-        raise Exception("Timeout waiting for running status: {} ".format(
-            instance_id))
+    Waiter(describe=describe_instance_states,
+           ready=lambda state: state == 'running',
+           failed=lambda state: state in ('shutting-down', 'terminated'),
+           description="running status", timeout=EC2_RUN_TIMEOUT,
+           max_delay=5,
+           retry_codes=['InvalidInstanceID.NotFound']).wait([instance_id])
+    status_delta = time.time() - status_start
+    run_summary.append(('EC2 Launch', status_delta))
+    print "[ OK ] {:0>2.0f}:{:0>2.0f}".format(
+        status_delta / 60,
+        status_delta % 60)
 
     print "{:<40}".format("Waiting for system status:"),
     system_start = time.time()
-    for _ in xrange(EC2_STATUS_TIMEOUT):
-        status = ec2.get_all_instance_status(inst.id)
-        if status[0].system_status.status == u'ok':
-            system_delta = time.time() - system_start
-            run_summary.append(('EC2 Status Checks', system_delta))
-            print "[ OK ] {:0>2.0f}:{:0>2.0f}".format(
-                system_delta / 60,
-                system_delta % 60)
-            break
-        else:
-            time.sleep(1)
-    else:
-        raise Exception("Timeout waiting for status checks: {} ".format(
-            instance_id))
+    Waiter(describe=lambda ids: dict(
+               (status.id, status.system_status.status)
+               for status in ec2.get_all_instance_status(instance_ids=ids)),
+           ready=lambda state: state == u'ok',
+           description="status checks", timeout=EC2_STATUS_TIMEOUT,
+           delay=5, max_delay=15).wait([instance_id])
+    system_delta = time.time() - system_start
+    run_summary.append(('EC2 Status Checks', system_delta))
+    print "[ OK ] {:0>2.0f}:{:0>2.0f}".format(
+        system_delta / 60,
+        system_delta % 60)
 
     print
     print "{:<40}".format(
         "Waiting for user-data, polling sqs for Ansible events:")
 
-    (ansible_delta, task_report) = poll_sqs_ansible()
+    (ansible_delta, ansible_tasks, summaries) = poll_sqs_ansible()
+    task_report.extend(ansible_tasks)
+    ansible_summaries.extend(summaries)
     run_summary.append(('Ansible run', ansible_delta))
     print
     print "{} longest Ansible tasks (seconds):".format(NUM_TASKS)
@@ -604,6 +1026,194 @@ def launch_and_configure(ec2_args):
 
     return run_summary, ami
 
+def get_builds():
+    """
+    Returns the list of (play, options) to bake
+    for --plays or --build-matrix, the options
+    override the ones abbey was called with.
+    """
+    if args.plays:
+        return [(play, {}) for play in args.plays.split(',') if play]
+
+    with open(args.build_matrix) as f:
+        matrix = yaml.load(f)
+    builds = []
+    for build in matrix:
+        if isinstance(build, basestring):
+            builds.append((build, {}))
+        else:
+            build = dict(build)
+            builds.append((build.pop('play'), build))
+    return builds
+
+
+def play_command(index, play, options, summary_file):
+    """
+    Returns the abbey command line that bakes the
+    index-th play of a multi-play run
+    """
+    # options that only apply to the multi-play run
+    multi_play = ['--plays', '--build-matrix', '--summary-file',
+                  '--build-index']
+
+    command = [sys.executable, '-u', os.path.abspath(__file__)]
+    argv = iter(sys.argv[1:])
+    for arg in argv:
+        if arg.split('=', 1)[0] in multi_play:
+            if '=' not in arg:
+                next(argv, None)
+        else:
+            command.append(arg)
+
+    # options given last override the ones given before
+    for key, value in sorted(options.iteritems()):
+        option = '--' + key.replace('_', '-')
+        if value is True:
+            command.append(option)
+        elif value not in (False, None):
+            command.extend([option, str(value)])
+
+    command.extend(['--play', play, '--summary-file', summary_file,
+                    '--build-index', str(index)])
+    return command
+
+
+def bake_plays(builds):
+    """
+    Runs one abbey process per play concurrently,
+    prints their output prefixed with the play name
+    and a summary of every play once they are done.
+    A play listed more than once is numbered after
+    its name, e.g. "edxapp #2".
+
+    Returns True if every play was baked.
+    """
+    counts = defaultdict(int)
+    for play, _ in builds:
+        counts[play] += 1
+    labels = []
+    seen = defaultdict(int)
+    for play, _ in builds:
+        seen[play] += 1
+        if counts[play] > 1:
+            labels.append("{} #{}".format(play, seen[play]))
+        else:
+            labels.append(play)
+
+    width = max(len(label) for label in labels)
+    output_lock = threading.Lock()
+    summary_dir = tempfile.mkdtemp(prefix='abbey-')
+
+    def relay(label, process):
+        for line in iter(process.stdout.readline, ''):
+            with output_lock:
+                print "{:<{}} | {}".format(label, width, line.rstrip('\n'))
+
+    runs = []
+    for index, (play, options) in enumerate(builds):
+        label = labels[index]
+        # named after the matrix entry, plays can be listed twice
+        summary_file = os.path.join(
+            summary_dir, '{}-{}.json'.format(index, play))
+        process = subprocess.Popen(
+            play_command(index, play, options, summary_file),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        relay_thread = threading.Thread(target=relay, args=(label, process))
+        relay_thread.daemon = True
+        relay_thread.start()
+        runs.append((label, process, relay_thread, summary_file))
+
+    summaries = []
+    for label, process, relay_thread, summary_file in runs:
+        process.wait()
+        relay_thread.join()
+        try:
+            with open(summary_file) as f:
+                summary = json.load(f)
+        except (IOError, ValueError):
+            summary = {'ami': None, 'total': None,
+                       'error': 'exited with status {}'.format(
+                           process.returncode)}
+        summaries.append((label, summary))
+    shutil.rmtree(summary_dir)
+
+    print
+    print "Summary:\n"
+    print "{:<{}}  {:<14} {:>8}  {}".format(
+        'Play', width, 'AMI', 'Time', 'Result')
+    for label, summary in summaries:
+        if summary['total'] is None:
+            total = ''
+        else:
+            total = "{:0>2.0f}:{:0>5.2f}".format(
+                summary['total'] / 60, summary['total'] % 60)
+        print "{:<{}}  {:<14} {:>8}  {}".format(
+            label, width, summary['ami'] or '-', total,
+            summary.get('error') or 'OK')
+
+    return all(not summary.get('error') for _, summary in summaries)
+
+
+def write_summary(ami, run_summary, error=None):
+    if args.summary_file:
+        total = None
+        for stage, delta in run_summary:
+            if stage == 'Total':
+                total = delta
+        with open(args.summary_file, 'w') as f:
+            json.dump({'play': args.play, 'ami': ami, 'total': total,
+                       'stages': run_summary, 'error': error}, f)
+
+
+def write_profile(ami, error=None):
+    """
+    Writes the stage and task timings of the run to
+    a JSON file in --profile-dir named after the run,
+    abbey-report.py aggregates them across runs
+    """
+    if args.no_profile or args.noop:
+        return
+
+    profile_dir = os.path.expanduser(args.profile_dir)
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+
+    tasks = []
+    for task in task_report:
+        # tasks of roles are named "role | task"
+        if task['TASK'] and ' | ' in task['TASK']:
+            role = task['TASK'].split(' | ', 1)[0]
+        else:
+            role = None
+        tasks.append({'task': task['TASK'], 'role': role,
+                      'module': task['MODULE'], 'prefix': task['PREFIX'],
+                      'host': task['HOST'], 'item': task['ITEM'],
+                      'handler': task['HANDLER'], 'delta': task['DELTA']})
+
+    profile = {
+        'run_id': run_id,
+        'start_time': start_time,
+        'play': args.play,
+        'environment': args.environment,
+        'deployment': args.deployment,
+        'base_ami': base_ami,
+        'configuration_version': args.configuration_version,
+        'instance_type': args.instance_type,
+        'ami': ami,
+        'error': error,
+        'stages': run_summary,
+        'tasks': tasks,
+        # the SUMMARY event of every playbook
+        'playbooks': ansible_summaries,
+    }
+    # written aside and renamed so reports never read half a profile
+    filename = os.path.join(profile_dir, '{}.json'.format(run_id))
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(profile, f, indent=1)
+    os.rename(filename + '.tmp', filename)
+    print "{:<40}{}".format("Wrote run profile:", filename)
+
+
 def send_hipchat_message(message):
     #If hipchat is configured send the details to the specified room
     if args.hipchat_api_token and args.hipchat_room_id:
@@ -619,7 +1229,14 @@ if __name__ == '__main__':
 
     args = parse_args()
 
+    if args.plays or args.build_matrix:
+        if not bake_plays(get_builds()):
+            sys.exit(1)
+        sys.exit(0)
+
     run_summary = []
+    task_report = []  # every Ansible task of the run, for the profile
+    ansible_summaries = []
 
     start_time = time.time()
 
@@ -667,6 +1284,8 @@ if __name__ == '__main__':
 
         run_id = "{}-abbey-{}-{}-{}".format(
             int(time.time() * 100), args.environment, args.deployment, args.play)
+        if args.build_index is not None:
+            run_id = "{}-{}".format(run_id, args.build_index)
 
         ec2_args = create_instance_args()
 
@@ -675,6 +1294,7 @@ if __name__ == '__main__':
                 run_id)
             pprint(ec2_args)
             ami = "ami-00000"
+            write_summary(ami, run_summary)
         else:
             run_summary, ami = launch_and_configure(ec2_args)
             print
@@ -684,6 +1304,8 @@ if __name__ == '__main__':
                 print "{:<30} {:0>2.0f}:{:0>5.2f}".format(
                     run[0], run[1] / 60, run[1] % 60)
             print "AMI: {}".format(ami)
+            write_summary(ami, run_summary)
+            write_profile(ami)
 
             message = 'Finished baking AMI {image_id} for {environment} ' \
               '{deployment} {play}.'.format(
@@ -701,6 +1323,8 @@ if __name__ == '__main__':
                 play=args.play,
                 exception=repr(e))
         send_hipchat_message(message)
+        write_summary(None, run_summary, error=repr(e))
+        write_profile(None, error=repr(e))
     finally:
         print
         if not args.no_cleanup and not args.noop:
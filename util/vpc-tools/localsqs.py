@@ -0,0 +1,219 @@
+"""
+In process stand-in for the SQS calls of the abbey event
+pipeline, the sqs callback plugin on one side and
+abbey.poll_sqs_ansible on the other.
+
+Like SQS it does not keep messages in order, may deliver
+a message more than once and lets messages take a while
+to become visible. How much of each, and the round trip
+time of every call, can be set to see how both sides
+hold up. Every call is counted by action.
+"""
+import time
+import random
+import itertools
+import threading
+from collections import defaultdict
+
+SQS_MAX_MESSAGE_BYTES = 256 * 1024
+SQS_BATCH_MAX_MESSAGES = 10
+SQS_BATCH_MAX_BYTES = 256 * 1024
+
+
+class LocalMessage(object):
+    """
+    The parts of a boto RawMessage abbey reads
+    """
+    def __init__(self, queue, message_id, body, sent_ts):
+        self.queue = queue
+        self.id = message_id
+        self.receipt_handle = None
+        self.body = body
+        self.attributes = {
+            'SentTimestamp': str(int(sent_ts * 1000)),
+        }
+
+    def get_body(self):
+        return self.body
+
+
+class BatchResults(object):
+    def __init__(self):
+        self.results = []
+        self.errors = []
+
+
+class LocalQueue(object):
+    """
+    A queue of LocalSQS. Sent messages become visible
+    after latency seconds, received ones are invisible
+    until they are deleted and are sent again with
+    probability duplicate_rate. get_messages returns
+    random visible messages rather than the oldest.
+    """
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.condition = threading.Condition()
+        # (visible_ts, message) not visible yet
+        self.delayed = []
+        self.visible = []
+        self.in_flight = {}
+        self.receipts = itertools.count()
+
+    def set_message_class(self, message_class):
+        pass
+
+    def count(self):
+        with self.condition:
+            self._release(time.time())
+            return len(self.visible) + len(self.delayed)
+
+    def get_messages(self, num_messages=1, visibility_timeout=None,
+                     attributes=None, wait_time_seconds=None):
+        self.conn._call('ReceiveMessage')
+        deadline = time.time() + (wait_time_seconds or 0)
+        with self.condition:
+            while True:
+                now = time.time()
+                self._release(now)
+                if self.visible or now >= deadline:
+                    break
+                # long poll until the next message becomes visible
+                wait = deadline - now
+                if self.delayed:
+                    wait = min(wait, min(ts for ts, _ in self.delayed) - now)
+                self.condition.wait(max(wait, 0.001))
+
+            count = min(num_messages, len(self.visible))
+            messages = [self.visible.pop(
+                self.conn.random.randrange(len(self.visible)))
+                for _ in range(count)]
+            for message in messages:
+                message.receipt_handle = str(next(self.receipts))
+                message.attributes.setdefault(
+                    'ApproximateFirstReceiveTimestamp',
+                    str(int(now * 1000)))
+                self.in_flight[message.receipt_handle] = message
+                if self.conn.random.random() < self.conn.duplicate_rate:
+                    self._add(self._copy(message), now)
+        return messages
+
+    def delete_message_batch(self, messages):
+        self.conn._call('DeleteMessageBatch')
+        results = BatchResults()
+        with self.condition:
+            for message in messages:
+                self.in_flight.pop(message.receipt_handle, None)
+                results.results.append({'id': message.id})
+        return results
+
+    def _copy(self, message):
+        copy = LocalMessage(self, message.id, message.body, 0)
+        copy.attributes = dict(message.attributes)
+        return copy
+
+    def _add(self, message, now):
+        latency = self.conn.latency
+        if self.conn.latency_jitter:
+            latency += self.conn.random.random() * self.conn.latency_jitter
+        self.delayed.append((now + latency, message))
+        self.condition.notify_all()
+
+    def _release(self, now):
+        ready = [message for ts, message in self.delayed if ts <= now]
+        if ready:
+            self.delayed = [(ts, message) for ts, message in self.delayed
+                            if ts > now]
+            self.visible.extend(ready)
+
+
+class LocalSQS(object):
+    """
+    Stands in for a boto SQSConnection.
+
+    latency - seconds before a sent message can be received
+    latency_jitter - up to this many more seconds, at
+                     random, which reorders messages
+    duplicate_rate - probability of a received message
+                     being delivered again
+    round_trip - seconds every call takes
+    """
+    def __init__(self, latency=0, latency_jitter=0, duplicate_rate=0,
+                 round_trip=0, seed=None, region='us-east-1'):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.duplicate_rate = duplicate_rate
+        self.round_trip = round_trip
+        self.random = random.Random(seed)
+        self.region = type('Region', (object,), {'name': region})()
+        self.queues = {}
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count()
+
+    def connect_to_region(self, region, **kwargs):
+        """
+        Replaces boto.sqs.connect_to_region to hand this
+        connection to code that makes its own
+        """
+        return self
+
+    def create_queue(self, name):
+        self._call('CreateQueue')
+        with self.lock:
+            if name not in self.queues:
+                self.queues[name] = LocalQueue(self, name)
+            return self.queues[name]
+
+    def delete_queue(self, queue):
+        self._call('DeleteQueue')
+        with self.lock:
+            self.queues.pop(queue.name, None)
+        return True
+
+    def send_message(self, queue, body, delay_seconds=None):
+        self._call('SendMessage')
+        if len(body) > SQS_MAX_MESSAGE_BYTES:
+            raise ValueError("message of {} bytes is over the SQS "
+                             "limit".format(len(body)))
+        with queue.condition:
+            message = self._message(queue, body)
+            queue._add(message, time.time())
+        return message
+
+    def send_message_batch(self, queue, messages):
+        """
+        Sends the (id, body, delay) entries of messages,
+        entries SQS would refuse end up in the errors
+        """
+        self._call('SendMessageBatch')
+        if len(messages) > SQS_BATCH_MAX_MESSAGES or \
+                sum(len(body) for _, body, _ in messages) > \
+                SQS_BATCH_MAX_BYTES:
+            raise ValueError("batch over the SQS limits")
+        results = BatchResults()
+        now = time.time()
+        with queue.condition:
+            for entry_id, body, _ in messages:
+                if len(body) > SQS_MAX_MESSAGE_BYTES:
+                    results.errors.append({
+                        'id': entry_id, 'sender_fault': 'true',
+                        'error_code': 'InvalidParameterValue',
+                        'error_message': 'Message too long'})
+                    continue
+                message = self._message(queue, body)
+                queue._add(message, now)
+                results.results.append({'id': entry_id,
+                                        'message_id': message.id})
+        return results
+
+    def _message(self, queue, body):
+        return LocalMessage(queue, str(next(self.message_ids)), body,
+                            time.time())
+
+    def _call(self, action):
+        with self.lock:
+            self.calls[action] += 1
+        if self.round_trip:
+            time.sleep(self.round_trip)
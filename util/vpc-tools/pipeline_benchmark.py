@@ -0,0 +1,311 @@
+#!/usr/bin/env python -u
+"""
+Benchmarks the abbey event pipeline without AWS.
+
+A recorded Ansible callback stream (see
+playbooks/callback_plugins/record.py), or a synthetic one,
+is replayed through the sqs callback plugin at a given rate.
+The events go through the localsqs stand-in, with its
+latency, reordering and duplicates, to abbey's
+poll_sqs_ansible. Reports the end to end latency of the
+events, the throughput, the SQS calls per event and how
+many events abbey showed out of order, twice or not at all.
+
+    python pipeline_benchmark.py --tasks 500 --rate 200 --jitter 0.5
+    python pipeline_benchmark.py --stream callbacks.jsonl --speed 10
+"""
+import os
+import sys
+import imp
+import json
+import time
+import random
+import threading
+from argparse import ArgumentParser, Namespace
+from collections import defaultdict
+
+import boto.sqs
+
+from localsqs import LocalSQS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PLUGIN = os.path.join(HERE, '..', '..', 'playbooks', 'callback_plugins',
+                      'sqs.py')
+ABBEY = os.path.join(HERE, 'abbey.py')
+MODULES = ['apt', 'pip', 'git', 'template', 'file', 'shell', 'service']
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--stream', metavar="CALLBACKS_FILE",
+                        help="recorded callback stream to replay, "
+                             "a synthetic one is generated otherwise")
+    parser.add_argument('--playbooks', type=int, default=2,
+                        help="playbooks in the synthetic stream")
+    parser.add_argument('--tasks', type=int, default=300,
+                        help="tasks per synthetic playbook")
+    parser.add_argument('--hosts', type=int, default=1,
+                        help="hosts of the synthetic playbooks")
+    parser.add_argument('--items', type=int, default=0,
+                        help="items of every looped synthetic task, "
+                             "a quarter of the tasks loop")
+    parser.add_argument('--result-bytes', type=int, default=500,
+                        help="size of the stdout of synthetic results")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="callbacks per second, 0 for as fast "
+                             "as possible")
+    parser.add_argument('--speed', type=float, default=0,
+                        help="replay the recorded timing this many "
+                             "times faster instead of --rate")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="seconds before a sent message is visible")
+    parser.add_argument('--jitter', type=float, default=0.2,
+                        help="up to this many seconds of extra latency, "
+                             "which reorders messages")
+    parser.add_argument('--duplicates', type=float, default=0.01,
+                        help="probability of a message being "
+                             "delivered twice")
+    parser.add_argument('--round-trip', type=float, default=0.02,
+                        help="seconds every SQS call takes")
+    parser.add_argument('--msg-delay', type=float, default=1,
+                        help="abbey --msg-delay")
+    parser.add_argument('--flush-interval', type=float, default=1,
+                        help="SQS_FLUSH_INTERVAL of the plugin")
+    parser.add_argument('--compress', action='store_true', default=False,
+                        help="set SQS_MSG_COMPRESS for the plugin")
+    parser.add_argument('--fields',
+                        help="SQS_MSG_FIELDS of the plugin")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', default=False,
+                        help="print the results as JSON")
+    return parser.parse_args()
+
+
+def load_stream(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_stream(playbooks, tasks, hosts, items, result_bytes, seed):
+    """
+    Returns the callbacks of playbooks that each run
+    tasks on hosts, with the shape of our plays
+    """
+    rand = random.Random(seed)
+    stream = []
+    t = 0.0
+    for playbook in range(playbooks):
+        stream.append({'t': t, 'callback': 'playbook_on_play_start',
+                       'args': ['all']})
+        stream.append({'t': t, 'callback': 'playbook_on_setup', 'args': []})
+        for task in range(tasks):
+            module = rand.choice(MODULES)
+            name = 'role{} | task {}'.format(task % 20, task)
+            stream.append({'t': t, 'callback': 'playbook_on_task_start',
+                           'args': [name, False]})
+            loop = range(items) if items and task % 4 == 0 else [None]
+            for host in range(hosts):
+                for item in loop:
+                    t += rand.expovariate(2)
+                    res = {
+                        'invocation': {'module_name': module,
+                                       'module_args': 'name=thing'},
+                        'changed': rand.random() < 0.3,
+                        'stdout': 'x' * result_bytes,
+                        'stderr': '',
+                    }
+                    if item is not None:
+                        res['item'] = 'item{}'.format(item)
+                    stream.append({
+                        't': t, 'callback': 'runner_on_ok',
+                        'args': ['host{}'.format(host), res]})
+        counters = dict((s, {}) for s in
+                        ['changed', 'failures', 'ok', 'processed', 'skipped'])
+        stream.append({'t': t, 'callback': 'playbook_on_stats',
+                       'args': [counters]})
+    return stream
+
+
+def split_playbooks(stream):
+    playbooks = [[]]
+    for event in stream:
+        playbooks[-1].append(event)
+        if event['callback'] == 'playbook_on_stats':
+            playbooks.append([])
+    return [playbook for playbook in playbooks if playbook]
+
+
+class Stats(object):
+    def __init__(self, counters):
+        self.__dict__.update(counters)
+
+
+def replay(playbooks, plugin, rate, speed, sent):
+    """
+    Feeds the callbacks of every playbook to a new sqs
+    plugin, the way ansible-playbook runs them one after
+    the other. Records the time every event was sent.
+    """
+    start = time.time()
+    count = 0
+    for playbook in playbooks:
+        callback = plugin.CallbackModule()
+        encode = callback.encoder.encode
+
+        def recording_encode(payload, encode=encode):
+            if 'SEQ' in payload:
+                sent[(payload['RUN'], payload['SEQ'])] = time.time()
+            return encode(payload)
+        callback.encoder.encode = recording_encode
+
+        offset = playbook[0]['t']
+        for event in playbook:
+            if rate:
+                due = start + count / rate
+            elif speed:
+                due = start + (event['t'] - offset) / speed
+            else:
+                due = 0
+            if due > time.time():
+                time.sleep(due - time.time())
+            args = list(event['args'])
+            if event['callback'] == 'playbook_on_stats':
+                args = [Stats(args[0])]
+            getattr(callback, event['callback'])(*args)
+            count += 1
+        # what atexit does when ansible-playbook exits
+        callback.publisher.close()
+        if speed:
+            start = time.time()
+    return count
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def run(playbooks, args):
+    conn = LocalSQS(latency=args.latency, latency_jitter=args.jitter,
+                    duplicate_rate=args.duplicates,
+                    round_trip=args.round_trip, seed=args.seed)
+    queue = conn.create_queue('pipeline-benchmark')
+
+    os.environ.update({
+        'ANSIBLE_ENABLE_SQS': 'true',
+        'SQS_REGION': 'us-east-1',
+        'SQS_NAME': queue.name,
+        'SQS_MSG_PREFIX': '[ benchmark ]',
+        'SQS_FLUSH_INTERVAL': str(args.flush_interval),
+    })
+    if args.compress:
+        os.environ['SQS_MSG_COMPRESS'] = 'true'
+    if args.fields:
+        os.environ['SQS_MSG_FIELDS'] = args.fields
+    boto.sqs.connect_to_region = conn.connect_to_region
+    plugin = imp.load_source('sqs_callback', PLUGIN)
+
+    stdout = sys.stdout
+    abbey = imp.load_source('abbey', ABBEY)
+    abbey.args = Namespace(msg_delay=args.msg_delay, verbose=False)
+    abbey.sqs_queue = queue
+    abbey.NUM_PLAYBOOKS = len(playbooks)
+
+    released = []
+
+    class RecordingBuffer(abbey.EventBuffer):
+        def pop_ready(self, now):
+            ready = super(RecordingBuffer, self).pop_ready(now)
+            now = time.time()
+            released.extend((now, msg_info['msg']) for msg_info in ready)
+            return ready
+    abbey.EventBuffer = RecordingBuffer
+
+    sent = {}
+    callbacks = []
+    replayer = threading.Thread(
+        target=lambda: callbacks.append(replay(
+            playbooks, plugin, args.rate, args.speed, sent)))
+    replayer.daemon = True
+
+    start = time.time()
+    replayer.start()
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        abbey.poll_sqs_ansible()
+    finally:
+        sys.stdout = stdout
+    end = time.time()
+    replayer.join()
+
+    latencies = []
+    seen = set()
+    duplicates = 0
+    out_of_order = 0
+    last_seq = {}
+    for released_ts, msg in released:
+        key = (msg.get('RUN'), msg.get('SEQ'))
+        if key in seen:
+            duplicates += 1
+            continue
+        seen.add(key)
+        if key in sent:
+            latencies.append(released_ts - sent[key])
+        if msg.get('SEQ') is not None:
+            if msg['SEQ'] < last_seq.get(msg['RUN'], -1):
+                out_of_order += 1
+            last_seq[msg['RUN']] = max(msg['SEQ'],
+                                       last_seq.get(msg['RUN'], -1))
+
+    calls = dict(conn.calls)
+    return {
+        'callbacks': callbacks[0],
+        'events': len(sent),
+        'seconds': end - start,
+        'events_per_second': len(sent) / (end - start),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_max': max(latencies) if latencies else None,
+        'sqs_calls': calls,
+        'sqs_calls_per_event': sum(calls.values()) / float(len(sent)),
+        'out_of_order': out_of_order,
+        'duplicates': duplicates,
+        'missing': len(set(sent) - seen),
+    }
+
+
+def main():
+    if args.stream:
+        stream = load_stream(args.stream)
+    else:
+        stream = synthetic_stream(args.playbooks, args.tasks, args.hosts,
+                                  args.items, args.result_bytes, args.seed)
+    result = run(split_playbooks(stream), args)
+
+    if args.json:
+        json.dump(result, sys.stdout, indent=1, sort_keys=True)
+        print
+        return
+
+    print "{:<24}{}".format("Callbacks:", result['callbacks'])
+    print "{:<24}{}".format("Events:", result['events'])
+    print "{:<24}{:.2f}s".format("Time:", result['seconds'])
+    print "{:<24}{:.1f}".format("Events per second:",
+                                result['events_per_second'])
+    print "{:<24}p50 {:.3f}s  p95 {:.3f}s  max {:.3f}s".format(
+        "Latency:", result['latency_p50'], result['latency_p95'],
+        result['latency_max'])
+    print "{:<24}{:.3f} ({})".format(
+        "SQS calls per event:", result['sqs_calls_per_event'], ', '.join(
+            "{} {}".format(action, count)
+            for action, count in sorted(result['sqs_calls'].iteritems())))
+    print "{:<24}{}".format("Out of order:", result['out_of_order'])
+    print "{:<24}{}".format("Duplicates shown:", result['duplicates'])
+    print "{:<24}{}".format("Missing:", result['missing'])
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main()
@@ -1,7 +1,7 @@
 """VPC Tools.
 
 Usage:
-    vpc-tools.py ssh-config (vpc <vpc_id> | stack-name <stack_name>) [(identity-file <identity_file>)] user <user> [(config-file <config_file>)] [(strict-host-check <strict_host_check>)]
+    vpc-tools.py ssh-config (vpc <vpc_id> | stack-name <stack_name> | vpcs <vpc_ids> | stack-names <stack_names> | stack-tag <stack_tag>) [(regions <regions>)] [(identity-file <identity_file>)] user <user> [(config-file <config_file>)] [(strict-host-check <strict_host_check>)] [(output <output_file>)]
     vpc-tools.py (-h --help)
     vpc-tools.py (-v --version)
 
@@ -9,11 +9,27 @@ Options:
     -h --help       Show this screen.
     -v --version    Show version.
 
+vpcs and stack-names take comma separated lists, stack-tag takes
+KEY=VALUE and selects every stack with that tag. Stacks are looked
+up in the comma separated regions, the default region otherwise,
+and their instances are fetched concurrently.
+
+With output, the config is written to output_file, which is left
+untouched if its content would not change.
 """
+import os
+import sys
+import hashlib
+import threading
 import boto
+import boto.ec2
+import boto.cloudformation
+from boto.cloudformation.stack import Stack
+from boto.exception import BotoServerError
 from docopt import docopt
 from vpcutil import vpc_for_stack_name
 from vpcutil import stack_name_for_vpc
+from vpcutil import connect_cloudformation
 from collections import defaultdict
 
 
@@ -56,17 +72,6 @@ def dispatch(args):
         _ssh_config(args)
 
 def _ssh_config(args):
-    if args.get("vpc"):
-      vpc_id = args.get("<vpc_id>")
-      stack_name = stack_name_for_vpc(vpc_id)
-    elif args.get("stack-name"):
-      stack_name = args.get("<stack_name>")
-      vpc_id = vpc_for_stack_name(stack_name)
-    else:
-      raise Exception("No vpc_id or stack_name provided.")
-
-    vpc = boto.connect_vpc()
-
     identity_file = args.get("<identity_file>", None)
     if identity_file:
         identity_line = "IdentityFile {}".format(identity_file)
@@ -88,86 +93,276 @@ def _ssh_config(args):
     else:
       config_file = ""
 
-    jump_box = "{stack_name}-bastion".format(stack_name=stack_name)
-    friendly = "{stack_name}-{logical_id}-{instance_number}"
-    id_type_counter = defaultdict(int)
+    options = {
+        'user': user,
+        'config_file': config_file,
+        'strict_host_check': strict_host_check,
+        'identity_line': identity_line,
+    }
+
+    regions = [None]
+    if args.get("<regions>"):
+        regions = args.get("<regions>").split(',')
+
+    stacks = _find_stacks(args, regions)
+    if not stacks:
+        raise Exception("No stacks found.")
+
+    # one thread per stack, with connections of their own
+    configs = {}
+    errors = []
+
+    def fetch(stack):
+        try:
+            configs[stack] = _stack_ssh_config(stack, options)
+        except Exception as e:
+            errors.append("{}: {}".format(stack[1], e))
+
+    threads = [threading.Thread(target=fetch, args=(stack,))
+               for stack in stacks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise Exception("Unable to fetch the instances of {}".format(
+            ", ".join(sorted(errors))))
+
+    content = "".join(configs[stack] for stack in sorted(stacks))
+    output_file = args.get("<output_file>")
+    if output_file:
+        _write_if_changed(os.path.expanduser(output_file), content)
+    else:
+        sys.stdout.write(content)
 
-    reservations = vpc.get_all_instances(filters={'vpc-id' : vpc_id})
 
-    for reservation in reservations:
-        for instance in reservation.instances:
+def _not_found(error):
+    """
+    Returns whether error is EC2 or CloudFormation saying
+    the vpc or stack does not exist
+    """
+    if not isinstance(error, BotoServerError):
+        return False
+    if error.error_code == 'InvalidVpcID.NotFound':
+        return True
+    return error.error_code == 'ValidationError' and \
+        'does not exist' in (error.error_message or '')
 
-            if 'play' in instance.tags:
-                logical_id = instance.tags['play']
-            elif 'role' in instance.tags:
-                # deprecated, use "play" instead
-                logical_id = instance.tags['role']
-            elif 'group' in instance.tags:
-                logical_id = instance.tags['group']
-            elif 'aws:cloudformation:logical-id' in instance.tags:
-                logical_id = instance.tags['aws:cloudformation:logical-id']
-            else:
-                continue
-            instance_number = id_type_counter[logical_id]
-            id_type_counter[logical_id] += 1
-
-            if logical_id == "BastionHost" or logical_id == 'bastion':
-
-                print BASTION_CONFIG.format(
-                    jump_box=jump_box,
-                    ip=instance.ip_address,
-                    user=user,
-                    strict_host_check=strict_host_check,
-                    identity_line=identity_line)
-
-                print BASTION_HOST_CONFIG.format(
-                    name=instance.private_ip_address,
-                    ip=instance.ip_address,
-                    user=user,
-                    instance_id=instance.id,
-                    strict_host_check=strict_host_check,
-                    identity_line=identity_line)
-
-                #duplicating for convenience with ansible
-                name = friendly.format(stack_name=stack_name,
-                                       logical_id=logical_id,
-                                       instance_number=instance_number)
-
-                print BASTION_HOST_CONFIG.format(
-                    name=name,
-                    ip=instance.ip_address,
-                    user=user,
-                    strict_host_check=strict_host_check,
-                    instance_id=instance.id,
-                    identity_line=identity_line)
 
+def _describe_stacks(region):
+    """
+    Returns every stack of a region, describe_stacks
+    only returns the first page of them
+    """
+    cfn = connect_cloudformation(region)
+    stacks = []
+    next_token = None
+    while True:
+        params = {}
+        if next_token:
+            params['NextToken'] = next_token
+        page = cfn.get_list('DescribeStacks', params, [('member', Stack)])
+        stacks.extend(page)
+        next_token = page.next_token
+        if not next_token:
+            break
+    return stacks
+
+
+def _find_stacks(args, regions):
+    """
+    Returns the (region, stack_name, vpc_id) of every stack
+    to generate the config of. Names are only looked up in
+    the regions that have them, every vpc and stack name
+    has to be found in at least one of them.
+    """
+    lookups = []
+    if args.get("vpc"):
+        vpc_id = args.get("<vpc_id>")
+        lookups.extend((region, vpc_id, None) for region in regions)
+    elif args.get("stack-name"):
+        stack_name = args.get("<stack_name>")
+        lookups.extend((region, None, stack_name) for region in regions)
+    elif args.get("vpcs"):
+        for vpc_id in set(args.get("<vpc_ids>").split(',')):
+            lookups.extend((region, vpc_id, None) for region in regions)
+    elif args.get("stack-names"):
+        for stack_name in set(args.get("<stack_names>").split(',')):
+            lookups.extend((region, None, stack_name) for region in regions)
+    elif args.get("stack-tag"):
+        key, value = args.get("<stack_tag>").split('=', 1)
+        for region in regions:
+            for stack in _describe_stacks(region):
+                # stacks without tags have a list of them
+                if stack.tags and stack.tags.get(key) == value:
+                    lookups.append((region, None, stack.stack_name))
+    else:
+        raise Exception("No vpc_id or stack_name provided.")
+
+    stacks = []
+    found = set()
+    errors = []
+    lock = threading.Lock()
+
+    def find(region, vpc_id=None, stack_name=None):
+        target = vpc_id or stack_name
+        try:
+            if vpc_id:
+                stack_name = stack_name_for_vpc(vpc_id, region=region)
             else:
-                # Print host config even for the bastion box because that is how
-                # ansible accesses it.
-                print HOST_CONFIG.format(
-                    name=instance.private_ip_address,
-                    jump_box=jump_box,
-                    ip=instance.private_ip_address,
-                    user=user,
-                    config_file=config_file,
-                    strict_host_check=strict_host_check,
-                    instance_id=instance.id,
-                    identity_line=identity_line)
-
-                #duplicating for convenience with ansible
-                name = friendly.format(stack_name=stack_name,
-                                       logical_id=logical_id,
-                                       instance_number=instance_number)
-
-                print HOST_CONFIG.format(
-                    name=name,
-                    jump_box=jump_box,
-                    ip=instance.private_ip_address,
-                    user=user,
-                    config_file=config_file,
-                    strict_host_check=strict_host_check,
-                    instance_id=instance.id,
-                    identity_line=identity_line)
+                vpc_id = vpc_for_stack_name(stack_name, region=region)
+        except Exception as e:
+            if not _not_found(e):
+                with lock:
+                    errors.append("{} in {}: {}".format(
+                        target, region or "the default region", e))
+            return
+        with lock:
+            found.add(target)
+            stacks.append((region, stack_name, vpc_id))
+
+    threads = [threading.Thread(target=find, args=lookup)
+               for lookup in lookups]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise Exception("Unable to look up {}".format(
+            ", ".join(sorted(errors))))
+    missing = sorted(set(vpc_id or stack_name
+                         for _, vpc_id, stack_name in lookups) - found)
+    if missing:
+        raise Exception("Not found in any region: {}".format(
+            ", ".join(missing)))
+    return sorted(stacks)
+
+
+def _write_if_changed(path, content):
+    """
+    Replaces the file at path with content atomically,
+    unless it already has that content
+    """
+    digest = hashlib.sha1(content).hexdigest()
+    try:
+        with open(path) as f:
+            if hashlib.sha1(f.read()).hexdigest() == digest:
+                print "{} is up to date".format(path)
+                return
+    except IOError:
+        pass
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    if os.path.exists(path):
+        # ssh refuses configs other users can write to
+        os.chmod(tmp_path, os.stat(path).st_mode & 0777)
+    else:
+        os.chmod(tmp_path, 0600)
+    os.rename(tmp_path, path)
+    print "Wrote {}".format(path)
+
+
+def _stack_ssh_config(stack, options):
+    """
+    Returns the ssh config of the instances of a stack,
+    the same instances always give the same config
+    """
+    region, stack_name, vpc_id = stack
+    if region:
+        ec2 = boto.ec2.connect_to_region(region)
+    else:
+        ec2 = boto.connect_vpc()
+
+    jump_box = "{stack_name}-bastion".format(stack_name=stack_name)
+    friendly = "{stack_name}-{logical_id}-{instance_number}"
+    id_type_counter = defaultdict(int)
+
+    reservations = ec2.get_all_instances(filters={'vpc-id' : vpc_id})
+    # numbered in launch order, which the API does not keep
+    instances = sorted(
+        (instance for reservation in reservations
+         for instance in reservation.instances),
+        key=lambda instance: (instance.launch_time, instance.id))
+
+    blocks = []
+    for instance in instances:
+
+        if 'play' in instance.tags:
+            logical_id = instance.tags['play']
+        elif 'role' in instance.tags:
+            # deprecated, use "play" instead
+            logical_id = instance.tags['role']
+        elif 'group' in instance.tags:
+            logical_id = instance.tags['group']
+        elif 'aws:cloudformation:logical-id' in instance.tags:
+            logical_id = instance.tags['aws:cloudformation:logical-id']
+        else:
+            continue
+        instance_number = id_type_counter[logical_id]
+        id_type_counter[logical_id] += 1
+
+        if logical_id == "BastionHost" or logical_id == 'bastion':
+
+            blocks.append(BASTION_CONFIG.format(
+                jump_box=jump_box,
+                ip=instance.ip_address,
+                user=options['user'],
+                strict_host_check=options['strict_host_check'],
+                identity_line=options['identity_line']))
+
+            blocks.append(BASTION_HOST_CONFIG.format(
+                name=instance.private_ip_address,
+                ip=instance.ip_address,
+                user=options['user'],
+                instance_id=instance.id,
+                strict_host_check=options['strict_host_check'],
+                identity_line=options['identity_line']))
+
+            #duplicating for convenience with ansible
+            name = friendly.format(stack_name=stack_name,
+                                   logical_id=logical_id,
+                                   instance_number=instance_number)
+
+            blocks.append(BASTION_HOST_CONFIG.format(
+                name=name,
+                ip=instance.ip_address,
+                user=options['user'],
+                strict_host_check=options['strict_host_check'],
+                instance_id=instance.id,
+                identity_line=options['identity_line']))
+
+        else:
+            # Print host config even for the bastion box because that is how
+            # ansible accesses it.
+            blocks.append(HOST_CONFIG.format(
+                name=instance.private_ip_address,
+                jump_box=jump_box,
+                ip=instance.private_ip_address,
+                user=options['user'],
+                config_file=options['config_file'],
+                strict_host_check=options['strict_host_check'],
+                instance_id=instance.id,
+                identity_line=options['identity_line']))
+
+            #duplicating for convenience with ansible
+            name = friendly.format(stack_name=stack_name,
+                                   logical_id=logical_id,
+                                   instance_number=instance_number)
+
+            blocks.append(HOST_CONFIG.format(
+                name=name,
+                jump_box=jump_box,
+                ip=instance.private_ip_address,
+                user=options['user'],
+                config_file=options['config_file'],
+                strict_host_check=options['strict_host_check'],
+                instance_id=instance.id,
+                identity_line=options['identity_line']))
+
+    # as print wrote them
+    return "".join(block + "\n" for block in blocks)
 
 if __name__ == '__main__':
     args = docopt(__doc__, version=VERSION)
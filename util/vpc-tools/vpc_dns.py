@@ -25,7 +25,9 @@
 import argparse
 import boto
 import datetime
+from boto.route53.record import ResourceRecordSets
 from vpcutil import vpc_for_stack_name
+from waiter import Waiter
 import xml.dom.minidom
 import sys
 
@@ -49,6 +51,18 @@ ELB_PLAY_MAPPINGS = {
 }
 
 
+# Limits of a single ChangeResourceRecordSets request
+MAX_CHANGES_PER_BATCH = 100
+MAX_VALUES_PER_BATCH = 1000
+MAX_VALUE_CHARS_PER_BATCH = 32000
+
+# Time to wait for submitted changes to reach INSYNC
+INSYNC_TIMEOUT = 600
+
+# rrsets of the zones loaded so far, by zone id
+zone_rrsets = {}
+
+
 class DNSRecord():
 
     def __init__(self, zone, record_name, record_type,
@@ -60,16 +74,179 @@ class DNSRecord():
         self.record_values = record_values
 
 
-def add_or_update_record(dns_records):
+def record_key(name):
+    # route53 returns fully qualified names
+    return name.rstrip('.').lower()
+
+
+def get_zone_rrsets(zone_id):
     """
-    Creates or updates a DNS record in a hosted route53
-    zone
+    Returns the rrsets of a zone as a dict of name to
+    {type: rrset}, reading every page of them once per run
     """
-    change_set = boto.route53.record.ResourceRecordSets()
+    if zone_id not in zone_rrsets:
+        rrsets = {}
+        name = rrset_type = identifier = None
+        while True:
+            page = r53.get_all_rrsets(zone_id, type=rrset_type, name=name,
+                                      identifier=identifier)
+            # iterating the page itself would fetch the next one
+            for rrset in list.__iter__(page):
+                # weighted sets share a name and type, the
+                # first one stands for them
+                rrsets.setdefault(record_key(rrset.name), {}).setdefault(
+                    rrset.type, rrset)
+            if not page.is_truncated:
+                break
+            name = page.next_record_name
+            rrset_type = page.next_record_type
+            identifier = getattr(page, 'NextRecordIdentifier', None)
+        zone_rrsets[zone_id] = rrsets
+    return zone_rrsets[zone_id]
+
+
+def plan_changes(dns_records):
+    """
+    Diffs the records against the rrsets of their zones,
+    returns a dict of zone id to the list of
+    (action, name, type, ttl, values) changes that make
+    the zones match the records
+    """
+    changes = {}
+    conflicts = []
     record_names = set()
 
     for record in dns_records:
+        key = record_key(record.record_name)
+        if key in record_names:
+            print("Unable to create record for {} with value {} because one already exists!".format(
+                record.record_values, record.record_name))
+            sys.exit(1)
+        record_names.add(key)
+
+        if record.zone:
+            zone_id = record.zone.Id.replace("/hostedzone/", "")
+            rrsets = get_zone_rrsets(zone_id)
+        else:
+            # the zone is only created without --noop
+            zone_id = None
+            rrsets = {}
+        zone_changes = changes.setdefault(zone_id, [])
+
+        existing = rrsets.get(key, {})
+        values = sorted(record.record_values)
+        same = existing.get(record.record_type)
+
+        if same and same.ttl and int(same.ttl) == record.record_ttl and \
+                sorted(map(record_key, same.resource_records)) == \
+                sorted(map(record_key, values)):
+            print("Record for {} already exists and is identical, skipping.".format(
+                record.record_name))
+            continue
+
+        if existing and not args.force:
+            conflicts.append(record.record_name)
+            continue
+
+        # the route53 API version of boto has no UPSERT, records
+        # are replaced by a DELETE and a CREATE in the same batch.
+        # A name has either a CNAME or records of other types.
+        for rrset_type, rrset in sorted(existing.iteritems()):
+            if rrset_type == record.record_type or \
+                    record.record_type == 'CNAME' or rrset_type == 'CNAME':
+                zone_changes.append(('DELETE', rrset.name, rrset.type,
+                                     rrset.ttl, rrset.resource_records))
+        zone_changes.append(('CREATE', record.record_name,
+                             record.record_type, record.record_ttl, values))
+
+    if conflicts:
+        raise RuntimeError(
+            "DNS records exist for {} and force was not specified.".format(
+                ', '.join(sorted(conflicts))))
+    return changes
+
+
+def change_batches(changes):
+    """
+    Splits the changes of a zone into as few
+    change_rrsets requests as the API limits allow,
+    the DELETE of a name goes with its CREATE
+    """
+    groups = []
+    for change in changes:
+        action, name = change[:2]
+        if groups and groups[-1][-1][0] == 'DELETE' and \
+                record_key(groups[-1][-1][1]) == record_key(name):
+            groups[-1].append(change)
+        else:
+            groups.append([change])
+
+    batches = []
+    batch = []
+    values = chars = 0
+    for group in groups:
+        group_values = sum(len(change[4]) for change in group)
+        group_chars = sum(len(value) for change in group
+                          for value in change[4])
+        if batch and (
+                len(batch) + len(group) > MAX_CHANGES_PER_BATCH or
+                values + group_values > MAX_VALUES_PER_BATCH or
+                chars + group_chars > MAX_VALUE_CHARS_PER_BATCH):
+            batches.append(batch)
+            batch = []
+            values = chars = 0
+        batch.extend(group)
+        values += group_values
+        chars += group_chars
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def submit_changes(zone_id, changes):
+    """
+    Submits the changes of a zone, returns the ids
+    of the submitted change batches
+    """
+    change_ids = []
+    for batch in change_batches(changes):
+        change_set = ResourceRecordSets()
+        for action, name, record_type, ttl, values in batch:
+            change = change_set.add_change(action, name, record_type, ttl)
+            for value in values:
+                change.add_value(value)
 
+        if args.noop:
+            print("Would have submitted the following change set:\n")
+        else:
+            print("Submitting the following change set:\n")
+        xml_doc = xml.dom.minidom.parseString(change_set.to_xml())
+        print(xml_doc.toprettyxml(newl=''))  # newl='' to remove extra newlines
+        if not args.noop:
+            response = r53.change_rrsets(zone_id, change_set.to_xml())
+            change_ids.append(
+                response['ChangeResourceRecordSetsResponse']['ChangeInfo']
+                ['Id'].replace('/change/', ''))
+    return change_ids
+
+
+def wait_for_changes(change_ids):
+    Waiter(describe=lambda ids: dict(
+               (change_id, r53.get_change(change_id)
+                   ['GetChangeResponse']['ChangeInfo']['Status'])
+               for change_id in ids),
+           ready=lambda status: status == 'INSYNC',
+           description="DNS changes to be in sync",
+           timeout=INSYNC_TIMEOUT, delay=5, max_delay=30).wait(change_ids)
+
+
+def add_or_update_record(dns_records):
+    """
+    Creates or updates DNS records in hosted route53
+    zones, each zone is read once and changed with as
+    few requests as possible
+    """
+    for record in dns_records:
         status_msg = """
         record_name:   {}
         record_type:   {}
@@ -82,60 +259,22 @@ def add_or_update_record(dns_records):
         else:
             print("Updating DNS record:\n{}".format(status_msg))
 
-        if record.record_name in record_names:
-            print("Unable to create record for {} with value {} because one already exists!".format(
-                record.record_values, record.record_name))
-            sys.exit(1)
-        record_names.add(record.record_name)
-
-        zone_id = record.zone.Id.replace("/hostedzone/", "")
-
-        records = r53.get_all_rrsets(zone_id)
-
-        old_records = {r.name[:-1]: r for r in records}
-
-        # If the record name already points to something.
-        # Delete the existing connection. If the record has
-        # the same type and name skip it.
-        if record.record_name in old_records.keys():
-            if record.record_name + "." == old_records[record.record_name].name and \
-                    record.record_type == old_records[record.record_name].type:
-                print("Record for {} already exists and is identical, skipping.\n".format(
-                    record.record_name))
-                continue
-
-            if args.force:
-                print("Deleting record:\n{}".format(status_msg))
-                change = change_set.add_change(
-                    'DELETE',
-                    record.record_name,
-                    record.record_type,
-                    record.record_ttl)
-            else:
-                raise RuntimeError(
-                    "DNS record exists for {} and force was not specified.".
-                    format(record.record_name))
-
-            for value in old_records[record.record_name].resource_records:
-                change.add_value(value)
-
-        change = change_set.add_change(
-            'CREATE',
-            record.record_name,
-            record.record_type,
-            record.record_ttl)
-
-        for value in record.record_values:
-            change.add_value(value)
+    change_ids = []
+    for zone_id, changes in plan_changes(dns_records).iteritems():
+        if not changes:
+            continue
+        for action, name, record_type, ttl, values in changes:
+            print("{} {} {} {}".format(action, name, record_type,
+                                       ", ".join(values)))
+        change_ids.extend(submit_changes(zone_id, changes))
+        if zone_id in zone_rrsets:
+            # the next plan for this zone has to read it again
+            del zone_rrsets[zone_id]
 
-    if args.noop:
-        print("Would have submitted the following change set:\n")
-    else:
-        print("Submitting the following change set:\n")
-    xml_doc = xml.dom.minidom.parseString(change_set.to_xml())
-    print(xml_doc.toprettyxml(newl=''))  # newl='' to remove extra newlines
-    if not args.noop:
-        r53.change_rrsets(zone_id, change_set.to_xml())
+    if args.wait and change_ids:
+        print("Waiting for {} change batches to be in sync".format(
+            len(change_ids)))
+        wait_for_changes(change_ids)
 
 
 def get_or_create_hosted_zone(zone_name):
@@ -182,22 +321,43 @@ def get_security_group_dns(group_name):
     return environment, deployment, play
 
 
-def get_dns_from_instances(elb):
+def get_instance_tags(vpc_id, elbs):
+    """
+    Returns the tags of every instance in the vpc and
+    attached to the elbs by instance id, in as few
+    describe calls as possible
+    """
+    instance_tags = {}
+    for reservation in ec2_con.get_all_instances(
+            filters={'vpc-id': vpc_id}):
+        for instance in reservation.instances:
+            instance_tags[instance.id] = instance.tags
+
+    # ELBs can have instances of other VPCs registered
+    missing = set(inst.id for elb in elbs for inst in elb.instances
+                  if inst.id not in instance_tags)
+    if missing:
+        for reservation in ec2_con.get_all_instances(
+                instance_ids=sorted(missing)):
+            for instance in reservation.instances:
+                instance_tags[instance.id] = instance.tags
+    return instance_tags
+
+
+def get_dns_from_instances(elb, instance_tags):
     for inst in elb.instances:
-        try:
-            instance = ec2_con.get_all_instances(
-                instance_ids=[inst.id])[0].instances[0]
-        except IndexError:
+        if inst.id not in instance_tags:
             print("instance {} attached to elb {}".format(inst, elb))
             sys.exit(1)
+        tags = instance_tags[inst.id]
         try:
-            env_tag = instance.tags['environment']
-            deployment_tag = instance.tags['deployment']
-            if 'play' in instance.tags:
-                play_tag = instance.tags['play']
+            env_tag = tags['environment']
+            deployment_tag = tags['deployment']
+            if 'play' in tags:
+                play_tag = tags['play']
             else:
                 # deprecated, for backwards compatibility
-                play_tag = instance.tags['role']
+                play_tag = tags['role']
             break  # only need the first instance for tag info
         except KeyError:
             print("Instance {}, attached to elb {} does not "
@@ -226,10 +386,14 @@ def update_elb_rds_dns(zone):
     else:
         zone_name = zone.Name[:-1]
 
+    # ELBs can't be listed by VPC, the tags of the instances
+    # behind them are read from the VPC all at once
     stack_elbs = [elb for elb in elb_con.get_all_load_balancers()
                   if elb.vpc_id == vpc_id]
+    instance_tags = get_instance_tags(vpc_id, stack_elbs)
     for elb in stack_elbs:
-        env_tag, deployment_tag, play_tag = get_dns_from_instances(elb)
+        env_tag, deployment_tag, play_tag = get_dns_from_instances(
+            elb, instance_tags)
 
         # Override the play tag if a substring of the elb name
         # is in ELB_PLAY_MAPPINGS
@@ -291,6 +455,10 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--force',
                         help="Force reuse of an existing name in a zone",
                         action="store_true", default=False)
+    parser.add_argument('-w', '--wait',
+                        help="Wait for the changes to be in sync on "
+                             "the route53 name servers",
+                        action="store_true", default=False)
     parser.add_argument('--aws-id', default=None,
                         help="read only aws key for fetching instance information"
                              "the account you wish add entries for")
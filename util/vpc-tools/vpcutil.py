@@ -1,21 +1,142 @@
+import os
+import json
+import time
+import threading
 import boto
+import boto.cloudformation
+import boto.vpc
 
-def vpc_for_stack_name(stack_name, aws_id=None, aws_secret=None):
-    cfn = boto.connect_cloudformation(aws_id, aws_secret)
-    resources = cfn.list_stack_resources(stack_name)
-    for resource in resources:
-      if resource.resource_type == 'AWS::EC2::VPC':
-        return resource.physical_resource_id
+# Where the resources of stacks are cached, and for how long
+# at most. An entry is also read again once its stack has
+# been updated.
+STACK_CACHE_PATH = os.environ.get(
+    'VPCUTIL_STACK_CACHE', os.path.expanduser('~/.vpcutil-stacks.json'))
+STACK_CACHE_TTL = int(os.environ.get('VPCUTIL_STACK_CACHE_TTL', 86400))
+# stacks can be looked up from several threads
+stack_cache_lock = threading.Lock()
+
+# Resource types kept under their own key of the stack metadata
+STACK_RESOURCE_KEYS = {
+    'AWS::EC2::Subnet': 'subnets',
+    'AWS::EC2::SecurityGroup': 'security_groups',
+    'AWS::ElasticLoadBalancing::LoadBalancer': 'elbs',
+}
+
+
+def load_stack_cache():
+    try:
+        with open(STACK_CACHE_PATH) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_stack_cache(cache):
+    # written aside and renamed, tools can run concurrently
+    tmp_path = '{}.{}.tmp'.format(STACK_CACHE_PATH, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp_path, STACK_CACHE_PATH)
+    except (IOError, OSError) as e:
+        print "Unable to write the stack cache {}: {}".format(
+            STACK_CACHE_PATH, e)
+
+
+def connect_cloudformation(region=None, aws_id=None, aws_secret=None):
+    if region:
+        return boto.cloudformation.connect_to_region(
+            region, aws_access_key_id=aws_id, aws_secret_access_key=aws_secret)
+    return boto.connect_cloudformation(aws_id, aws_secret)
+
+
+def stack_cache_key(stack_name, region=None):
+    if region:
+        return '{}:{}'.format(region, stack_name)
+    return stack_name
+
+
+def stack_metadata(stack_name, aws_id=None, aws_secret=None, region=None):
+    """
+    Returns the resources of a stack as a dict with its
+    vpc_id, the subnets, security_groups and elbs by
+    logical id, and every resource by type and logical id.
+
+    Resources are listed once and cached, later calls
+    only describe the stack to find out whether it has
+    been updated since.
+    """
+    cfn = connect_cloudformation(region, aws_id, aws_secret)
+    stack = cfn.describe_stacks(stack_name)[0]
+    # stacks that were never updated have no LastUpdatedTime
+    updated = getattr(stack, 'LastUpdatedTime', None) or \
+        stack.creation_time.isoformat()
+
+    cache = load_stack_cache()
+    key = stack_cache_key(stack_name, region)
+    metadata = cache.get(key)
+    if metadata and metadata['stack_id'] == stack.stack_id and \
+            metadata['updated'] == updated and \
+            time.time() - metadata['fetched'] < STACK_CACHE_TTL:
+        return metadata
+
+    resources = {}
+    next_token = None
+    while True:
+        page = cfn.list_stack_resources(stack_name, next_token=next_token)
+        for resource in page:
+            resources.setdefault(resource.resource_type, {})[
+                resource.logical_resource_id] = \
+                resource.physical_resource_id
+        next_token = page.next_token
+        if not next_token:
+            break
+
+    metadata = {
+        'stack_name': stack_name,
+        'region': region,
+        'stack_id': stack.stack_id,
+        'updated': updated,
+        'fetched': time.time(),
+        'vpc_id': None,
+        'resources': resources,
+    }
+    vpcs = resources.get('AWS::EC2::VPC', {})
+    if vpcs:
+        metadata['vpc_id'] = vpcs.values()[0]
+    for resource_type, name in STACK_RESOURCE_KEYS.iteritems():
+        metadata[name] = resources.get(resource_type, {})
+
+    with stack_cache_lock:
+        # other stacks may have been cached in the meantime
+        cache = load_stack_cache()
+        cache[key] = metadata
+        save_stack_cache(cache)
+    return metadata
+
+
+def vpc_for_stack_name(stack_name, aws_id=None, aws_secret=None,
+                       region=None):
+    return stack_metadata(stack_name, aws_id, aws_secret, region)['vpc_id']
+
+def stack_name_for_vpc(vpc_name, aws_id=None, aws_secret=None, region=None):
+    # stacks cached recently enough are trusted without
+    # describing the VPC
+    for metadata in load_stack_cache().itervalues():
+        if metadata['vpc_id'] == vpc_name and \
+                metadata.get('region') == region and \
+                time.time() - metadata['fetched'] < STACK_CACHE_TTL:
+            return metadata['stack_name']
 
-def stack_name_for_vpc(vpc_name):
     cfn_tag_key = 'aws:cloudformation:stack-name'
-    vpc = boto.connect_vpc(aws_id, aws_secret)
+    if region:
+        vpc = boto.vpc.connect_to_region(
+            region, aws_access_key_id=aws_id, aws_secret_access_key=aws_secret)
+    else:
+        vpc = boto.connect_vpc(aws_id, aws_secret)
     resource = vpc.get_all_vpcs(vpc_ids=[vpc_name])[0]
     if cfn_tag_key in resource.tags:
         return resource.tags[cfn_tag_key]
     else:
         msg = "VPC({}) is not part of a cloudformation stack.".format(vpc_name)
         raise Exception(msg)
-
-
-
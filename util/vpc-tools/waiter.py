@@ -0,0 +1,128 @@
+import time
+import random
+
+from boto.exception import BotoServerError
+
+# Error codes AWS returns when requests are being rate limited
+THROTTLING_CODES = [
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+]
+
+
+def is_throttled(error):
+    return error.error_code in THROTTLING_CODES or error.status == 503
+
+
+def retry_throttled(call, timeout=60, delay=1, max_delay=15, backoff=2,
+                    jitter=0.5, retry_codes=None):
+    """
+    Returns call(), calling it again with exponential backoff
+    and jitter for as long as AWS rate limits it, or fails
+    with one of retry_codes, for up to timeout seconds
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return call()
+        except BotoServerError as e:
+            retry = is_throttled(e) or e.error_code in (retry_codes or [])
+            if not retry or time.time() >= deadline:
+                raise
+        sleep = delay * (1 - jitter * random.random())
+        time.sleep(max(0, min(sleep, deadline - time.time())))
+        delay = min(delay * backoff, max_delay)
+
+
+class WaiterTimeout(Exception):
+    pass
+
+
+class WaiterFailure(Exception):
+    pass
+
+
+class Waiter(object):
+    """
+    Waits for many resources at once to reach a state.
+
+    describe is called with the list of resource ids that
+    are not ready yet and returns a dict of id to state,
+    one API call covers every resource. ready(state) tells
+    whether a resource is done, failed(state) whether it will
+    never be.
+
+    Between calls the delay grows exponentially up to
+    max_delay, with random jitter so that concurrent waiters
+    do not poll in lockstep. All resources share a deadline
+    of timeout seconds. Throttling errors, and the errors in
+    retry_codes (e.g. a resource that is not visible yet),
+    are retried until the deadline.
+    """
+    def __init__(self, describe, ready, description, timeout,
+                 failed=None, delay=1, max_delay=15, backoff=2,
+                 jitter=0.5, retry_codes=None, progress=None):
+        self.describe = describe
+        self.ready = ready
+        self.failed = failed
+        self.description = description
+        self.timeout = timeout
+        self.delay = delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.retry_codes = set(THROTTLING_CODES + list(retry_codes or []))
+        # called as progress(pending, elapsed) after every
+        # call that leaves resources pending
+        self.progress = progress
+
+    def wait(self, resource_ids):
+        """
+        Blocks until every resource is ready, returns the
+        dict of resource id to its last state
+        """
+        start = time.time()
+        deadline = start + self.timeout
+        delay = self.delay
+        pending = list(resource_ids)
+        states = {}
+
+        while True:
+            try:
+                states.update(self.describe(pending))
+            except BotoServerError as e:
+                if e.error_code not in self.retry_codes and \
+                        not is_throttled(e):
+                    raise
+                if is_throttled(e):
+                    # back off harder while rate limited
+                    delay = min(delay * self.backoff, self.max_delay)
+
+            pending = [resource_id for resource_id in pending
+                       if resource_id not in states or
+                       not self.ready(states[resource_id])]
+            if not pending:
+                return states
+
+            if self.failed:
+                failed = [resource_id for resource_id in pending
+                          if resource_id in states and
+                          self.failed(states[resource_id])]
+                if failed:
+                    raise WaiterFailure("Failed waiting for {}: {}".format(
+                        self.description, ', '.join(
+                            "{} ({})".format(resource_id, states[resource_id])
+                            for resource_id in failed)))
+
+            now = time.time()
+            if now >= deadline:
+                raise WaiterTimeout("Timeout waiting for {}: {}".format(
+                    self.description, ', '.join(pending)))
+            if self.progress:
+                self.progress(pending, now - start)
+
+            sleep = delay * (1 - self.jitter * random.random())
+            time.sleep(min(sleep, deadline - now))
+            delay = min(delay * self.backoff, self.max_delay)